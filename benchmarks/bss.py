@@ -0,0 +1,70 @@
+"""
+Latency and accuracy of :class:`~ftlib.finetune.bss.BatchSpectralShrinkage` against the full SVD implementation.
+
+The error is the relative difference of the loss and of the gradient w.r.t. the features.
+"""
+import sys
+import argparse
+import itertools
+
+import prettytable
+import torch
+
+sys.path.append('..')
+from ftlib.finetune.bss import BatchSpectralShrinkage
+from harness import measure
+
+
+def svd_bss(feature, k=1):
+    """The previous implementation, which runs a full SVD."""
+    result = 0
+    u, s, v = torch.svd(feature.t())
+    num = s.size(0)
+    for i in range(k):
+        result += torch.pow(s[num - 1 - i], 2)
+    return result
+
+
+def loss_and_grad(loss_fn, feature):
+    feature = feature.detach().requires_grad_()
+    loss = loss_fn(feature)
+    loss.backward()
+    return loss.detach(), feature.grad
+
+
+def main(args: argparse.Namespace):
+    device = torch.device(args.device)
+    table = prettytable.PrettyTable(["b", "f", "k", "svd ms", "bss ms", "speedup", "loss error", "grad error"])
+    for batch_size, feature_dim, k in itertools.product(args.batch_sizes, args.feature_dims, args.k):
+        torch.manual_seed(args.seed)
+        # pooled features after a ReLU, like the ResNet features BSS is applied to
+        feature = torch.randn(batch_size, feature_dim, device=device).relu().requires_grad_()
+        bss = BatchSpectralShrinkage(k=k)
+
+        svd_timing = measure(lambda: svd_bss(feature, k).backward(), device, warmup=args.warmup, repeat=args.repeat)
+        bss_timing = measure(lambda: bss(feature).backward(), device, warmup=args.warmup, repeat=args.repeat)
+
+        svd_loss, svd_grad = loss_and_grad(lambda x: svd_bss(x, k), feature)
+        bss_loss, bss_grad = loss_and_grad(bss, feature)
+        row = [batch_size, feature_dim, k,
+               '{:.3f}'.format(svd_timing['median_ms']), '{:.3f}'.format(bss_timing['median_ms']),
+               '{:.2f}x'.format(svd_timing['median_ms'] / bss_timing['median_ms']),
+               '{:.2e}'.format(((bss_loss - svd_loss).abs() / svd_loss.abs()).item()),
+               '{:.2e}'.format(((bss_grad - svd_grad).norm() / svd_grad.norm()).item())]
+        print(' '.join(str(entry) for entry in row))
+        table.add_row(row)
+    print(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Batch Spectral Shrinkage')
+    parser.add_argument('-b', '--batch-sizes', nargs='+', type=int, default=[16, 32, 64, 128, 256],
+                        help='batch sizes to sweep')
+    parser.add_argument('-f', '--feature-dims', nargs='+', type=int, default=[2048],
+                        help='feature dimensions to sweep')
+    parser.add_argument('-k', nargs='+', type=int, default=[1], help='numbers of penalized singular values')
+    parser.add_argument('--device', default='cpu', type=str, help='device to run on')
+    parser.add_argument('--warmup', default=3, type=int, help='number of untimed iterations')
+    parser.add_argument('--repeat', default=20, type=int, help='number of timed iterations')
+    parser.add_argument('--seed', default=0, type=int, help='seed for the random inputs')
+    main(parser.parse_args())
@@ -0,0 +1,197 @@
+"""
+Benchmark forward + backward latency and peak memory of the loss modules in the hot training paths.
+
+Typical usage::
+
+    # record the current tree as the baseline
+    python dalib_losses.py --save-baseline baselines/losses.json
+    # after a change, compare against it
+    python dalib_losses.py --baseline baselines/losses.json
+"""
+import sys
+import argparse
+import functools
+import itertools
+import os
+import os.path as osp
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append('..')
+from dalib.modules.kernels import GaussianKernel
+from dalib.modules.domain_discriminator import DomainDiscriminator
+from dalib.modules.multidomain_discriminator import MultidomainDiscriminator
+from dalib.adaptation.dan import MultipleKernelMaximumMeanDiscrepancy
+from dalib.adaptation.jan import JointMultipleKernelMaximumMeanDiscrepancy
+from dalib.adaptation.cdan import ConditionalDomainAdversarialLoss, RandomizedMultiLinearMap
+from dalib.adaptation.mdd import ClassificationMarginDisparityDiscrepancy
+from dalib.adaptation.mcc import MinimumClassConfusionLoss
+from dalib.adaptation.mdann import MultidomainAdversarialLoss
+from dalib.adaptation.keypoint_detection.regda import PseudoLabelGenerator, RegressionDisparity
+from ftlib.finetune.bss import BatchSpectralShrinkage
+from common.vision.models.keypoint_detection.loss import JointsKLLoss
+from harness import measure, case_name, save_results, load_results, compare
+
+
+def _randn(*size, device):
+    return torch.randn(*size, device=device, requires_grad=True)
+
+
+def gaussian_kernel(batch_size, feature_dim, device, **kwargs):
+    kernel = GaussianKernel(alpha=1.).to(device)
+    features = _randn(2 * batch_size, feature_dim, device=device)
+    return lambda: kernel(features).sum().backward()
+
+
+def mkmmd(batch_size, feature_dim, device, **kwargs):
+    loss = MultipleKernelMaximumMeanDiscrepancy([GaussianKernel(alpha=2 ** k) for k in range(-3, 2)]).to(device)
+    z_s, z_t = _randn(batch_size, feature_dim, device=device), _randn(batch_size, feature_dim, device=device)
+    return lambda: loss(z_s, z_t).backward()
+
+
+def jmmd(batch_size, feature_dim, num_classes, device, **kwargs):
+    loss = JointMultipleKernelMaximumMeanDiscrepancy((
+        [GaussianKernel(alpha=2 ** k) for k in range(-3, 2)],
+        (GaussianKernel(sigma=0.92, track_running_stats=False),)
+    ), linear=False).to(device)
+    f_s, f_t = _randn(batch_size, feature_dim, device=device), _randn(batch_size, feature_dim, device=device)
+    g_s, g_t = _randn(batch_size, num_classes, device=device), _randn(batch_size, num_classes, device=device)
+
+    def step():
+        loss((f_s, F.softmax(g_s, dim=1)), (f_t, F.softmax(g_t, dim=1))).backward()
+    return step
+
+
+def cdan(batch_size, feature_dim, num_classes, device, **kwargs):
+    discriminator = DomainDiscriminator(feature_dim * num_classes, hidden_size=1024)
+    loss = ConditionalDomainAdversarialLoss(discriminator).to(device)
+    f_s, f_t = _randn(batch_size, feature_dim, device=device), _randn(batch_size, feature_dim, device=device)
+    g_s, g_t = _randn(batch_size, num_classes, device=device), _randn(batch_size, num_classes, device=device)
+    return lambda: loss(g_s, f_s, g_t, f_t).backward()
+
+
+def cdan_factorized(batch_size, feature_dim, num_classes, device, **kwargs):
+    discriminator = DomainDiscriminator(feature_dim * num_classes, hidden_size=1024)
+    loss = ConditionalDomainAdversarialLoss(discriminator, factorized=True).to(device)
+    f_s, f_t = _randn(batch_size, feature_dim, device=device), _randn(batch_size, feature_dim, device=device)
+    g_s, g_t = _randn(batch_size, num_classes, device=device), _randn(batch_size, num_classes, device=device)
+    return lambda: loss(g_s, f_s, g_t, f_t).backward()
+
+
+def cdan_randomized(batch_size, feature_dim, num_classes, device, randomized_dim=1024, sparse=False, **kwargs):
+    discriminator = DomainDiscriminator(randomized_dim, hidden_size=1024)
+    loss = ConditionalDomainAdversarialLoss(discriminator, randomized=True, num_classes=num_classes,
+                                            features_dim=feature_dim, randomized_dim=randomized_dim)
+    loss.map = RandomizedMultiLinearMap(feature_dim, num_classes, randomized_dim, sparse=sparse)
+    loss = loss.to(device)
+    f_s, f_t = _randn(batch_size, feature_dim, device=device), _randn(batch_size, feature_dim, device=device)
+    g_s, g_t = _randn(batch_size, num_classes, device=device), _randn(batch_size, num_classes, device=device)
+    return lambda: loss(g_s, f_s, g_t, f_t).backward()
+
+
+def mdd(batch_size, num_classes, device, **kwargs):
+    loss = ClassificationMarginDisparityDiscrepancy(margin=4.).to(device)
+    y_s, y_s_adv, y_t, y_t_adv = [_randn(batch_size, num_classes, device=device) for _ in range(4)]
+    return lambda: loss(y_s, y_s_adv, y_t, y_t_adv).backward()
+
+
+def mcc(batch_size, num_classes, device, **kwargs):
+    loss = MinimumClassConfusionLoss(temperature=2.5).to(device)
+    g_t = _randn(batch_size, num_classes, device=device)
+    return lambda: loss(g_t).backward()
+
+
+def mdann(batch_size, feature_dim, device, num_domains=4, **kwargs):
+    discriminator = MultidomainDiscriminator(feature_dim, hidden_size=1024, num_domains=num_domains)
+    loss = MultidomainAdversarialLoss(discriminator).to(device)
+    f = _randn(2 * batch_size, feature_dim, device=device)
+    d_labels = torch.randint(num_domains, (2 * batch_size,), device=device)
+    return lambda: loss(f, d_labels).backward()
+
+
+def bss(batch_size, feature_dim, device, **kwargs):
+    loss = BatchSpectralShrinkage(k=1).to(device)
+    feature = _randn(batch_size, feature_dim, device=device)
+    return lambda: loss(feature).backward()
+
+
+def regda(batch_size, num_classes, device, height=64, width=64, **kwargs):
+    # num_classes plays the role of the number of keypoints here
+    loss = RegressionDisparity(PseudoLabelGenerator(num_classes, height, width), JointsKLLoss()).to(device)
+    y = torch.randn(batch_size, num_classes, height, width, device=device)
+    y_adv = _randn(batch_size, num_classes, height, width, device=device)
+    return lambda: loss(y, y_adv, mode='max').backward()
+
+
+# name -> (builder, the sweep dimensions the case depends on)
+CASES = {
+    'gaussian_kernel': (gaussian_kernel, ('batch_size', 'feature_dim')),
+    'mkmmd': (mkmmd, ('batch_size', 'feature_dim')),
+    'jmmd': (jmmd, ('batch_size', 'feature_dim', 'num_classes')),
+    'cdan': (cdan, ('batch_size', 'feature_dim', 'num_classes')),
+    'cdan_factorized': (cdan_factorized, ('batch_size', 'feature_dim', 'num_classes')),
+    'cdan_randomized': (cdan_randomized, ('batch_size', 'feature_dim', 'num_classes')),
+    'cdan_randomized_sparse': (functools.partial(cdan_randomized, sparse=True),
+                               ('batch_size', 'feature_dim', 'num_classes')),
+    'mdd': (mdd, ('batch_size', 'num_classes')),
+    'mcc': (mcc, ('batch_size', 'num_classes')),
+    'mdann': (mdann, ('batch_size', 'feature_dim')),
+    'bss': (bss, ('batch_size', 'feature_dim')),
+    'regda': (regda, ('batch_size', 'num_classes')),
+}
+
+SHORT_NAMES = {'batch_size': 'b', 'feature_dim': 'f', 'num_classes': 'c'}
+
+
+def run(args: argparse.Namespace, cases=CASES):
+    device = torch.device(args.device)
+    sweep = {'batch_size': args.batch_sizes, 'feature_dim': args.feature_dims, 'num_classes': args.num_classes}
+    results = {}
+    for name in args.cases:
+        builder, dims = cases[name]
+        for values in itertools.product(*[sweep[dim] for dim in dims]):
+            params = dict(zip(dims, values))
+            key = case_name(name, **{SHORT_NAMES[dim]: value for dim, value in params.items()})
+            torch.manual_seed(args.seed)
+            step = builder(device=device, **params)
+            results[key] = measure(step, device, warmup=args.warmup, repeat=args.repeat)
+            print('{}: {:.3f} ms, {:.2f} MB'.format(key, results[key]['median_ms'], results[key]['peak_mb']))
+    return results
+
+
+def get_parser(cases=CASES, **defaults):
+    parser = argparse.ArgumentParser(description='Benchmark loss modules')
+    parser.add_argument('--cases', nargs='+', default=list(cases), choices=list(cases),
+                        help='cases to run (default: all)')
+    parser.add_argument('-b', '--batch-sizes', nargs='+', type=int, default=defaults.get('batch_sizes', [32, 64]),
+                        help='batch sizes per domain to sweep')
+    parser.add_argument('-f', '--feature-dims', nargs='+', type=int,
+                        default=defaults.get('feature_dims', [256, 2048]), help='feature dimensions to sweep')
+    parser.add_argument('-c', '--num-classes', nargs='+', type=int, default=defaults.get('num_classes', [31, 65]),
+                        help='class counts to sweep')
+    parser.add_argument('--device', default='cpu', type=str, help='device to run on')
+    parser.add_argument('--warmup', default=3, type=int, help='number of untimed iterations')
+    parser.add_argument('--repeat', default=20, type=int, help='number of timed iterations')
+    parser.add_argument('--seed', default=0, type=int, help='seed for the random inputs')
+    parser.add_argument('--baseline', default=None, type=str,
+                        help='json file of a previous run to compare against')
+    parser.add_argument('--save-baseline', default=None, type=str,
+                        help='store the results of this run as a json file')
+    parser.add_argument('--threshold', default=0.1, type=float,
+                        help='relative change that is reported as a regression / improvement')
+    return parser
+
+
+def main(args: argparse.Namespace, cases=CASES):
+    results = run(args, cases)
+    baseline = load_results(args.baseline) if args.baseline is not None else None
+    print(compare(results, baseline, args.threshold))
+    if args.save_baseline is not None:
+        if osp.dirname(args.save_baseline):
+            os.makedirs(osp.dirname(args.save_baseline), exist_ok=True)
+        save_results(results, args.save_baseline)
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
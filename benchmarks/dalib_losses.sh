@@ -0,0 +1,19 @@
+#!/usr/bin/env bash
+# Record a baseline of the current tree on CPU
+python dalib_losses.py --save-baseline baselines/dalib_losses_cpu.json
+# Compare a modified tree against the stored baseline
+python dalib_losses.py --baseline baselines/dalib_losses_cpu.json
+# Larger sweep on GPU
+CUDA_VISIBLE_DEVICES=0 python dalib_losses.py --device cuda -b 32 64 128 -f 256 1024 2048 -c 31 65 345 --save-baseline baselines/dalib_losses_cuda.json
+# Memory of the kernel losses on the DAN / JAN configurations (ResNet-50 pooled features)
+python dalib_losses.py --cases gaussian_kernel mkmmd jmmd -b 32 64 -f 2048 -c 31 65 --baseline baselines/dalib_losses_cpu.json
+# Accuracy vs. speed of the random fourier features estimator of MK-MMD / JMMD
+python mmd_estimators.py -b 32 128 512 -f 256 2048 -D 256 1024 4096
+# CDAN with the multilinear map fused into the first discriminator layer
+python dalib_losses.py --cases cdan cdan_factorized -b 32 256 -f 256 -c 65
+# dense vs sparse random projection of the randomized multilinear map
+python dalib_losses.py --cases cdan_randomized cdan_randomized_sparse -b 32 256 -f 2048 -c 65
+# Batch Spectral Shrinkage against the full SVD implementation
+python bss.py -b 16 32 64 128 256 -f 2048 -k 1 4
+# kernel ECE grid lookup against the previous argmin over the whole grid
+python kernel_ece.py -n 10000 30000 100000
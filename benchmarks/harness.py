@@ -0,0 +1,122 @@
+"""
+Utilities shared by the benchmark scripts in this directory.
+
+A benchmark *case* is a callable which builds its inputs once and returns a closure that runs a
+single forward + backward step. :func:`measure` times that closure and records its peak memory,
+:func:`save_results` / :func:`load_results` store the measurements as json and :func:`compare`
+formats a report against a stored baseline.
+"""
+import json
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import prettytable
+import torch
+
+
+def peak_memory(step: Callable[[], None], device: torch.device) -> float:
+    """Return the peak memory (in MB) allocated while running ``step`` once.
+
+    On cuda devices the allocator statistics are used. On cpu the allocation events recorded by
+    :mod:`torch.profiler` are replayed in chronological order to recover the high-water mark.
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        step()
+        torch.cuda.synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / 2 ** 20
+
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        step()
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    current = peak = 0
+    for event in events:
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak / 2 ** 20
+
+
+def measure(step: Callable[[], None], device: torch.device, warmup: Optional[int] = 3,
+            repeat: Optional[int] = 20) -> Dict[str, float]:
+    """Measure latency and peak memory of ``step``.
+
+    Args:
+        step (callable): runs one forward + backward pass.
+        device (torch.device): device the step runs on.
+        warmup (int, optional): number of untimed iterations. Default: 3
+        repeat (int, optional): number of timed iterations. Default: 20
+
+    Returns:
+        dict with the median / mean / std latency in milliseconds and the peak memory in MB.
+    """
+    for _ in range(warmup):
+        step()
+    timings = []
+    for _ in range(repeat):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        timings.append((time.perf_counter() - start) * 1000.)
+    timings = np.array(timings)
+    return {
+        'median_ms': float(np.median(timings)),
+        'mean_ms': float(timings.mean()),
+        'std_ms': float(timings.std()),
+        'peak_mb': peak_memory(step, device)
+    }
+
+
+def case_name(name: str, **params) -> str:
+    """Build the key under which a measurement is stored, e.g. ``mkmmd[b=32,f=256]``."""
+    return '{}[{}]'.format(name, ','.join('{}={}'.format(k, v) for k, v in params.items()))
+
+
+def save_results(results: Dict[str, Dict[str, float]], path: str):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> Dict[str, Dict[str, float]]:
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]] = None,
+            threshold: Optional[float] = 0.1) -> str:
+    """Format ``results`` as a table, comparing against ``baseline`` when given.
+
+    A case is flagged as ``slower`` / ``faster`` (``more mem`` / ``less mem``) when its median latency
+    (peak memory) differs from the baseline by more than ``threshold`` (relative).
+    """
+    if baseline is None:
+        baseline = {}
+    table = prettytable.PrettyTable(["case", "median ms", "base ms", "speedup", "peak MB", "base MB", "status"])
+    table.align["case"] = "l"
+    for name in sorted(results):
+        result = results[name]
+        row = [name, '{:.3f}'.format(result['median_ms']), '-', '-', '{:.2f}'.format(result['peak_mb']), '-', 'new']
+        if name in baseline:
+            base = baseline[name]
+            speedup = base['median_ms'] / max(result['median_ms'], 1e-9)
+            row[2] = '{:.3f}'.format(base['median_ms'])
+            row[3] = '{:.2f}x'.format(speedup)
+            row[5] = '{:.2f}'.format(base['peak_mb'])
+            status: List[str] = []
+            if speedup < 1. / (1. + threshold):
+                status.append('slower')
+            elif speedup > 1. + threshold:
+                status.append('faster')
+            if result['peak_mb'] > base['peak_mb'] * (1. + threshold):
+                status.append('more mem')
+            elif result['peak_mb'] < base['peak_mb'] / (1. + threshold):
+                status.append('less mem')
+            row[6] = ', '.join(status) if status else 'same'
+        table.add_row(row)
+    return table.get_string()
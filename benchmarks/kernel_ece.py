@@ -0,0 +1,63 @@
+"""
+Latency of :func:`utils_ajay.kernel_ece` and of its grid lookup against the previous lookup, which compared each
+prediction with every grid point.
+
+The lookups must return the same grid points, so the ECE and the estimated accuracies are identical.
+"""
+import sys
+import argparse
+import itertools
+
+import numpy as np
+import prettytable
+import torch
+
+sys.path.append('..')
+from utils_ajay import kernel_ece, kde_grid, closest_grid_points
+from harness import measure
+
+
+def argmin_closest_grid_points(x, values):
+    """The previous lookup, O(N G) in a python loop."""
+    return [np.abs(x - pr).argmin() for pr in values]
+
+
+def main(args: argparse.Namespace):
+    device = torch.device('cpu')
+    x = kde_grid()
+    table = prettytable.PrettyTable(["n", "c", "argmin lookup ms", "lookup ms", "speedup", "kernel_ece ms",
+                                     "identical"])
+    for num_samples, num_classes in itertools.product(args.num_samples, args.num_classes):
+        rng = np.random.default_rng(args.seed)
+        logits = rng.normal(scale=2., size=(num_samples, num_classes))
+        probs = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+        labels = rng.integers(num_classes, size=num_samples)
+        classes = list(range(num_classes))
+        max_prob = probs.max(axis=1)
+
+        argmin_timing = measure(lambda: argmin_closest_grid_points(x, max_prob), device,
+                                warmup=args.warmup, repeat=args.repeat)
+        lookup_timing = measure(lambda: closest_grid_points(x, max_prob), device,
+                                warmup=args.warmup, repeat=args.repeat)
+        kernel_ece_timing = measure(lambda: kernel_ece(probs, labels, classes), device,
+                                    warmup=args.warmup, repeat=args.repeat)
+        identical = np.array_equal(argmin_closest_grid_points(x, max_prob), closest_grid_points(x, max_prob))
+        row = [num_samples, num_classes,
+               '{:.3f}'.format(argmin_timing['median_ms']), '{:.3f}'.format(lookup_timing['median_ms']),
+               '{:.0f}x'.format(argmin_timing['median_ms'] / lookup_timing['median_ms']),
+               '{:.3f}'.format(kernel_ece_timing['median_ms']), identical]
+        print(' '.join(str(entry) for entry in row))
+        table.add_row(row)
+    print(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the kernel ECE')
+    parser.add_argument('-n', '--num-samples', nargs='+', type=int, default=[10000, 30000, 100000],
+                        help='numbers of predictions to sweep')
+    parser.add_argument('-c', '--num-classes', nargs='+', type=int, default=[4],
+                        help='class counts to sweep')
+    parser.add_argument('--warmup', default=1, type=int, help='number of untimed iterations')
+    parser.add_argument('--repeat', default=3, type=int, help='number of timed iterations')
+    parser.add_argument('--seed', default=0, type=int, help='seed for the random inputs')
+    main(parser.parse_args())
@@ -0,0 +1,116 @@
+"""
+Accuracy vs. speed of the random fourier features estimator of MK-MMD / JMMD against the exact kernel estimator.
+
+The error is measured against the exact (biased) estimate computed from the full kernel matrix,
+which is what the random features estimator approximates.
+"""
+import sys
+import argparse
+import itertools
+
+import numpy as np
+import prettytable
+import torch
+import torch.nn.functional as F
+
+sys.path.append('..')
+from dalib.modules.kernels import GaussianKernel, GaussianKernelBank
+from dalib.adaptation.dan import MultipleKernelMaximumMeanDiscrepancy
+from dalib.adaptation.jan import JointMultipleKernelMaximumMeanDiscrepancy
+from harness import measure
+
+
+def dan_kernels():
+    return [GaussianKernel(alpha=2 ** k) for k in range(-3, 2)]
+
+
+def jan_kernels():
+    return dan_kernels(), (GaussianKernel(sigma=0.92, track_running_stats=False),)
+
+
+def exact_discrepancy(layer_kernels, z_s, z_t):
+    """Biased estimate of the discrepancy computed from the full (product) kernel matrix."""
+    batch_size = z_s[0].size(0)
+    kernel_matrix = 1.
+    for kernels, layer_z_s, layer_z_t in zip(layer_kernels, z_s, z_t):
+        kernel_matrix = kernel_matrix * GaussianKernelBank(kernels)(torch.cat([layer_z_s, layer_z_t]))
+    return (kernel_matrix[:batch_size, :batch_size].mean() + kernel_matrix[batch_size:, batch_size:].mean()
+            - 2 * kernel_matrix[:batch_size, batch_size:].mean()).item()
+
+
+def sample(method, batch_size, feature_dim, num_classes, shift, device):
+    z_s = torch.randn(batch_size, feature_dim, device=device, requires_grad=True)
+    z_t = (torch.randn(batch_size, feature_dim, device=device) + shift).requires_grad_()
+    if method == 'dan':
+        return (z_s,), (z_t,)
+    g_s = F.softmax(torch.randn(batch_size, num_classes, device=device), dim=1)
+    g_t = F.softmax(torch.randn(batch_size, num_classes, device=device) + shift, dim=1)
+    return (z_s, g_s), (z_t, g_t)
+
+
+def build(method, random_features_dim, device):
+    if method == 'dan':
+        kernels = dan_kernels()
+        if random_features_dim is None:
+            return MultipleKernelMaximumMeanDiscrepancy(kernels).to(device), (kernels,)
+        return MultipleKernelMaximumMeanDiscrepancy(kernels, random_features=True,
+                                                    random_features_dim=random_features_dim).to(device), (kernels,)
+    kernels = jan_kernels()
+    if random_features_dim is None:
+        return JointMultipleKernelMaximumMeanDiscrepancy(kernels, linear=False).to(device), kernels
+    return JointMultipleKernelMaximumMeanDiscrepancy(kernels, random_features=True,
+                                                     random_features_dim=random_features_dim).to(device), kernels
+
+
+def call(method, loss, z_s, z_t):
+    return loss(*z_s, *z_t) if method == 'dan' else loss(z_s, z_t)
+
+
+def main(args: argparse.Namespace):
+    device = torch.device(args.device)
+    table = prettytable.PrettyTable(["method", "b", "f", "estimator", "median ms", "peak MB", "rel. error"])
+    for method, batch_size, feature_dim in itertools.product(args.methods, args.batch_sizes, args.feature_dims):
+        for random_features_dim in [None] + args.random_features_dims:
+            torch.manual_seed(args.seed)
+            loss, layer_kernels = build(method, random_features_dim, device)
+            z_s, z_t = sample(method, batch_size, feature_dim, args.num_classes, args.shift, device)
+            timing = measure(lambda: call(method, loss, z_s, z_t).backward(), device,
+                             warmup=args.warmup, repeat=args.repeat)
+
+            errors = []
+            if random_features_dim is not None:
+                for trial in range(args.trials):
+                    torch.manual_seed(args.seed + trial)
+                    loss, layer_kernels = build(method, random_features_dim, device)
+                    z_s, z_t = sample(method, batch_size, feature_dim, args.num_classes, args.shift, device)
+                    with torch.no_grad():
+                        estimate = call(method, loss, z_s, z_t).item()
+                        exact = exact_discrepancy(layer_kernels, z_s, z_t)
+                    errors.append(abs(estimate - exact) / abs(exact))
+
+            row = [method, batch_size, feature_dim,
+                   'exact' if random_features_dim is None else 'rff D={}'.format(random_features_dim),
+                   '{:.3f}'.format(timing['median_ms']), '{:.2f}'.format(timing['peak_mb']),
+                   '-' if len(errors) == 0 else '{:.3f}'.format(np.mean(errors))]
+            print(' '.join(str(entry) for entry in row))
+            table.add_row(row)
+    print(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy vs. speed of MMD estimators')
+    parser.add_argument('--methods', nargs='+', default=['dan', 'jan'], choices=['dan', 'jan'])
+    parser.add_argument('-b', '--batch-sizes', nargs='+', type=int, default=[32, 128, 512],
+                        help='batch sizes per domain to sweep')
+    parser.add_argument('-f', '--feature-dims', nargs='+', type=int, default=[256, 2048],
+                        help='feature dimensions to sweep')
+    parser.add_argument('-c', '--num-classes', default=31, type=int, help='number of classes (jan only)')
+    parser.add_argument('-D', '--random-features-dims', nargs='+', type=int, default=[256, 1024, 4096],
+                        help='dimensions of the random fourier features to sweep')
+    parser.add_argument('--shift', default=0.1, type=float, help='mean shift between source and target samples')
+    parser.add_argument('--trials', default=5, type=int, help='number of random draws to average the error over')
+    parser.add_argument('--device', default='cpu', type=str, help='device to run on')
+    parser.add_argument('--warmup', default=3, type=int, help='number of untimed iterations')
+    parser.add_argument('--repeat', default=10, type=int, help='number of timed iterations')
+    parser.add_argument('--seed', default=0, type=int, help='seed for the random inputs')
+    main(parser.parse_args())
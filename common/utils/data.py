@@ -1,3 +1,6 @@
+import random
+import torch
+from torch.utils.data.dataset import Dataset
 from torch.utils.data.dataloader import DataLoader
 
 
@@ -19,3 +22,41 @@ class ForeverDataIterator:
         return len(self.data_loader)
 
 
+class DeterministicAugmentationDataset(Dataset):
+    r"""Wraps a dataset so that the random augmentation of each sample is drawn from a fixed set of
+    `num_augmentations` seeds.
+
+    Each sample is returned together with its index and the index of its augmentation seed, which together identify
+    the augmented input. This allows to reuse the outputs of a frozen model on the same augmented inputs, e.g. with
+    :class:`~ftlib.finetune.delta.ActivationCache`.
+
+    Args:
+        dataset (Dataset): The dataset to wrap. Its random augmentations must use the `random` or `torch` generators.
+        num_augmentations (int): Number of different augmentations of each sample.
+        seed (int, optional): Base seed of the augmentations. Default: 0
+
+    Returns:
+        `(*dataset[index], index, augmentation)`
+    """
+    def __init__(self, dataset: Dataset, num_augmentations: int, seed: int = 0):
+        self.dataset = dataset
+        self.num_augmentations = num_augmentations
+        self.seed = seed
+
+    def __getitem__(self, index):
+        augmentation = random.randrange(self.num_augmentations)
+        random_state = random.getstate()
+        seed = self.seed + index * self.num_augmentations + augmentation
+        # only the cpu generator is reseeded (torch.manual_seed would also reseed the cuda generators),
+        # and its state is restored afterwards
+        with torch.random.fork_rng(devices=[]):
+            random.seed(seed)
+            torch.default_generator.manual_seed(seed)
+            try:
+                data = self.dataset[index]
+            finally:
+                random.setstate(random_state)
+        return (*data, index, augmentation)
+
+    def __len__(self):
+        return len(self.dataset)
@@ -44,6 +44,8 @@ class ConfusionMatrix(object):
     def __init__(self, num_classes):
         self.num_classes = num_classes
         self.mat = None
+        # (acc_global, acc, iu), computed lazily and dropped whenever the matrix changes
+        self._summary = None
 
     def update(self, target, output):
         """
@@ -64,25 +66,32 @@ class ConfusionMatrix(object):
             k = (target >= 0) & (target < n)
             inds = n * target[k].to(torch.int64) + output[k]
             self.mat += torch.bincount(inds, minlength=n**2).reshape(n, n)
+        self._summary = None
 
     def reset(self):
-        self.mat.zero_()
+        if self.mat is not None:
+            self.mat.zero_()
+        self._summary = None
 
     def compute(self):
         """compute global accuracy, per-class accuracy and per-class IoU"""
-        h = self.mat.float()
-        acc_global = torch.diag(h).sum() / h.sum()
-        acc = torch.diag(h) / h.sum(1)
-        iu = torch.diag(h) / (h.sum(1) + h.sum(0) - torch.diag(h))
-        return acc_global, acc, iu
-
-    # def reduce_from_all_processes(self):
-    #     if not torch.distributed.is_available():
-    #         return
-    #     if not torch.distributed.is_initialized():
-    #         return
-    #     torch.distributed.barrier()
-    #     torch.distributed.all_reduce(self.mat)
+        if self._summary is None:
+            h = self.mat.float()
+            acc_global = torch.diag(h).sum() / h.sum()
+            acc = torch.diag(h) / h.sum(1)
+            iu = torch.diag(h) / (h.sum(1) + h.sum(0) - torch.diag(h))
+            self._summary = acc_global, acc, iu
+        return self._summary
+
+    def reduce_from_all_processes(self):
+        """Sum the confusion matrices of all processes. Does nothing outside of distributed training."""
+        if not torch.distributed.is_available():
+            return
+        if not torch.distributed.is_initialized():
+            return
+        torch.distributed.barrier()
+        torch.distributed.all_reduce(self.mat)
+        self._summary = None
 
     def __str__(self):
         acc_global, acc, iu = self.compute()
@@ -107,3 +116,70 @@ class ConfusionMatrix(object):
         return 'global correct: {:.1f}\nmean correct:{:.1f}\nmean IoU: {:.1f}\n{}'.format(
             acc_global.item() * 100, acc.mean().item() * 100, iu.mean().item() * 100, table.get_string())
 
+
+class SegmentationEvaluator(ConfusionMatrix):
+    r"""
+    A :class:`ConfusionMatrix` updated directly from the segmentation logits.
+
+    The argmax over the classes is written in place into the indices of the confusion matrix, and pixels whose
+    label is outside of :math:`[0, C)` (e.g. the ignore label 255) go to a sentinel bin instead of being gathered
+    with a boolean mask, so that no per-pixel copy of the labels or the predictions is made and the update does
+    not wait for a host synchronization to know the number of valid pixels.
+    Summaries are only computed when :meth:`compute` is called and are cached until the next update, so
+    call it at display intervals rather than after each mini-batch.
+
+    Args:
+        num_classes (int): number of classes :math:`C`
+        distributed (bool, optional): If True, :meth:`compute` sums the confusion matrices of all processes
+          before the first summary after an update, so it must then be called by all processes. Default: False
+
+    Inputs:
+        - target (tensor): ground truth labels
+        - output (tensor): logits (or any scores) of the model
+
+    Shape:
+        - target: :math:`(minibatch, *)`
+        - output: :math:`(minibatch, C, *)`
+
+    Examples::
+
+        >>> evaluator = SegmentationEvaluator(num_classes=19)
+        >>> for x, label in data_loader:
+        ...     evaluator.update(label, interp(model(x)))
+        >>> acc_global, acc, iu = evaluator.compute()
+    """
+
+    def __init__(self, num_classes, distributed=False):
+        super(SegmentationEvaluator, self).__init__(num_classes)
+        self.distributed = distributed
+        self._local_mat = None
+
+    def update(self, target, output):
+        n = self.num_classes
+        self._restore_local()
+        if self.mat is None:
+            self.mat = torch.zeros((n, n), dtype=torch.int64, device=target.device)
+        with torch.no_grad():
+            inds = output.argmax(1).flatten()
+            target = target.flatten().to(torch.int64)
+            inds.add_(target, alpha=n)
+            inds.masked_fill_((target < 0) | (target >= n), n ** 2)
+            self.mat += torch.bincount(inds, minlength=n ** 2 + 1)[:n ** 2].reshape(n, n)
+        self._summary = None
+
+    def compute(self):
+        if self.distributed and self._local_mat is None and self.mat is not None:
+            # keep the local counts aside so that later updates are not added to the reduced matrix
+            self._local_mat = self.mat
+            self.mat = self.mat.clone()
+            self.reduce_from_all_processes()
+        return super(SegmentationEvaluator, self).compute()
+
+    def reset(self):
+        self._restore_local()
+        super(SegmentationEvaluator, self).reset()
+
+    def _restore_local(self):
+        if self._local_mat is not None:
+            self.mat, self._local_mat = self._local_mat, None
+            self._summary = None
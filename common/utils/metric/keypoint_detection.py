@@ -1,12 +1,16 @@
 # TODO: add documentation
 import numpy as np
+import torch
 
 
 def get_max_preds(batch_heatmaps):
     '''
     get predictions from score maps
-    heatmaps: numpy.ndarray([batch_size, num_joints, height, width])
+    heatmaps: numpy.ndarray([batch_size, num_joints, height, width]) or torch.Tensor of the same shape,
+    in which case the predictions are computed on the device of the heatmaps
     '''
+    if isinstance(batch_heatmaps, torch.Tensor):
+        return _get_max_preds_torch(batch_heatmaps)
     assert isinstance(batch_heatmaps, np.ndarray), \
         'batch_heatmaps should be numpy.ndarray'
     assert batch_heatmaps.ndim == 4, 'batch_images should be 4-ndim'
@@ -33,19 +37,33 @@ def get_max_preds(batch_heatmaps):
     return preds, maxvals
 
 
+def _get_max_preds_torch(batch_heatmaps):
+    assert batch_heatmaps.dim() == 4, 'batch_images should be 4-ndim'
+    batch_size, num_joints, _, width = batch_heatmaps.shape
+    maxvals, idx = batch_heatmaps.reshape(batch_size, num_joints, -1).max(dim=2, keepdim=True)
+    preds = torch.cat([idx % width, torch.div(idx, width, rounding_mode='floor')], dim=2).float()
+    preds *= (maxvals > 0).float()
+    return preds, maxvals
+
+
 def calc_dists(preds, target, normalize):
+    """
+    Normalized distances between the predicted and target keypoints in shape (num_joints, batch_size).
+    The distance is -1 where the target keypoint is not visible, i.e. where x <= 1 or y <= 1.
+    Accepts numpy arrays or tensors, in which case the distances are computed on the device of `preds`.
+    """
+    if isinstance(preds, torch.Tensor):
+        preds, target = preds.float(), target.float()
+        normalize = torch.as_tensor(normalize, dtype=torch.float32, device=preds.device).view(-1, 1, 2)
+        dists = ((preds - target) / normalize).norm(dim=2)
+        visible = (target[:, :, 0] > 1) & (target[:, :, 1] > 1)
+        return torch.where(visible, dists, torch.full_like(dists, -1)).t()
     preds = preds.astype(np.float32)
     target = target.astype(np.float32)
-    dists = np.zeros((preds.shape[1], preds.shape[0]))
-    for n in range(preds.shape[0]):
-        for c in range(preds.shape[1]):
-            if target[n, c, 0] > 1 and target[n, c, 1] > 1:
-                normed_preds = preds[n, c, :] / normalize[n]
-                normed_targets = target[n, c, :] / normalize[n]
-                dists[c, n] = np.linalg.norm(normed_preds - normed_targets)
-            else:
-                dists[c, n] = -1
-    return dists
+    normalize = np.asarray(normalize).reshape(-1, 1, 2)
+    dists = np.linalg.norm(preds / normalize - target / normalize, axis=2)
+    visible = (target[:, :, 0] > 1) & (target[:, :, 1] > 1)
+    return np.where(visible, dists, -1).T
 
 
 def dist_acc(dists, thr=0.5):
@@ -88,3 +106,71 @@ def accuracy(output, target, hm_type='gaussian', thr=0.5):
     avg_acc = avg_acc / cnt if cnt != 0 else 0
 
     return acc, avg_acc, cnt, pred
+
+
+class PCK(object):
+    r"""
+    Accumulate the Percentage of Correct Keypoints (PCK) over an epoch, with the same definition as
+    :meth:`accuracy`. Predictions and distances are computed on the device of the heatmaps and only the
+    per-keypoint counts of correct and visible keypoints are kept, so :meth:`update` never synchronizes
+    with the device. Unlike averaging the per-batch results of :meth:`accuracy`, every visible keypoint
+    of the epoch has the same weight.
+
+    Args:
+        thr (float): threshold on the normalized distance, below which a keypoint is correct. Default: 0.5
+
+    Inputs for :meth:`update`:
+        - output (tensor): predicted heatmaps
+        - target (tensor): ground truth heatmaps
+
+    Shape:
+        - output, target: :math:`(minibatch, K, H, W)` where K means the number of keypoints
+
+    Examples::
+
+        >>> pck = PCK()
+        >>> for x, label in data_loader:
+        ...     pred = pck.update(model(x), label)
+        >>> acc_per_points, avg_acc = pck.compute()
+    """
+
+    def __init__(self, thr=0.5):
+        self.thr = thr
+        self.correct = None
+        self.visible = None
+
+    def update(self, output, target):
+        """
+        Add the keypoints of a mini-batch to the counts.
+
+        Returns:
+            predicted keypoints on the heatmaps in shape :math:`(minibatch, K, 2)`
+        """
+        with torch.no_grad():
+            pred, _ = get_max_preds(output)
+            target, _ = get_max_preds(target)
+            h, w = output.shape[2], output.shape[3]
+            dists = calc_dists(pred, target, [h / 10, w / 10])
+            visible = dists != -1
+            if self.correct is None:
+                self.correct = torch.zeros(dists.shape[0], dtype=torch.int64, device=dists.device)
+                self.visible = torch.zeros(dists.shape[0], dtype=torch.int64, device=dists.device)
+            self.correct += ((dists < self.thr) & visible).sum(dim=1)
+            self.visible += visible.sum(dim=1)
+        return pred
+
+    def reset(self):
+        if self.correct is not None:
+            self.correct.zero_()
+            self.visible.zero_()
+
+    def compute(self):
+        """
+        Returns:
+            - accuracy of each keypoint (numpy.ndarray), -1 for keypoints that are never visible
+            - average accuracy over the keypoints which are visible at least once
+        """
+        correct, visible = self.correct.cpu().double().numpy(), self.visible.cpu().double().numpy()
+        acc = np.where(visible > 0, correct / np.maximum(visible, 1), -1)
+        avg_acc = acc[visible > 0].mean() if (visible > 0).any() else 0
+        return acc, avg_acc
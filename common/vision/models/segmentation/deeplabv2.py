@@ -1,6 +1,10 @@
+from typing import Optional, Sequence
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision.models.utils import load_state_dict_from_url
 
+__all__ = ['Deeplab', 'deeplabv2_resnet101']
 
 model_urls = {
     'deeplabv2_resnet101': 'https://cloud.tsinghua.edu.cn/f/2d9a7fc43ce34f76803a/?dl=1'
@@ -191,3 +195,108 @@ def deeplabv2_resnet101(num_classes=19, pretrained_backbone=True):
         backbone.load_state_dict(new_params)
     classifier = ASPP_V2(2048, [6, 12, 18, 24], [6, 12, 18, 24], num_classes)
     return Deeplab(backbone, classifier, num_classes)
+
+
+@torch.no_grad()
+def tiled_inference(model: nn.Module, x: torch.Tensor, output_size: Sequence[int],
+                    tile_size: Optional[Sequence[int]] = None, overlap: Optional[float] = 1. / 3,
+                    batch_size: Optional[int] = 1, flip: Optional[bool] = False,
+                    align_corners: Optional[bool] = True, output_device: Optional[torch.device] = None) -> torch.Tensor:
+    r"""Sliding-window inference of a segmentation model on full-resolution images.
+
+    The input images are split into overlapping tiles of :attr:`tile_size`. The logits of each tile are upsampled
+    to the footprint of the tile at :attr:`output_size` and blended into a preallocated output buffer with a
+    separable window that decays linearly towards the tile borders, so that the peak memory of the model is bounded
+    by the tile size and only the output buffer grows with the image size. Where a tile spans a whole side of the
+    image, the window is constant along that side, thus with ``tile_size=None`` the result is the same as
+    upsampling the logits of the whole images.
+
+    Args:
+        model (torch.nn.Module): segmentation model, which outputs logits of shape :math:`(N, C, h, w)`
+        x (tensor): input images
+        output_size (tuple(int)): (height, width) of the output logits
+        tile_size (tuple(int), optional): (height, width) of the tiles on the input images.
+          If None, use the whole images. Default: None
+        overlap (float, optional): fraction of the tile size by which neighbouring tiles overlap. Default: 1/3
+        batch_size (int, optional): number of tiles forwarded through the model at a time. Each tile is cut from
+          all the :math:`N` input images. Default: 1
+        flip (bool, optional): If True, also forward the horizontally flipped tiles in the same batch and average
+          their flipped logits with those of the original tiles. Default: False
+        align_corners (bool, optional): ``align_corners`` of the bilinear upsampling. Default: True
+        output_device (torch.device, optional): device of the output buffer, e.g. ``'cpu'`` to keep the full
+          resolution logits off the accelerator. Default: the device of :attr:`x`
+
+    Shape:
+        - x: :math:`(N, 3, H, W)`
+        - Outputs: :math:`(N, C, H_{out}, W_{out})` where :math:`(H_{out}, W_{out})` is :attr:`output_size`
+
+    Examples::
+
+        >>> model = deeplabv2_resnet101(num_classes=19).eval()
+        >>> x = torch.randn(1, 3, 512, 1024)
+        >>> output = tiled_inference(model, x, output_size=(1024, 2048), tile_size=(512, 512), flip=True)
+    """
+    n, _, height, width = x.shape
+    output_height, output_width = output_size
+    tile_height, tile_width = (height, width) if tile_size is None else \
+        (min(tile_size[0], height), min(tile_size[1], width))
+    scale_height, scale_width = output_height / height, output_width / width
+    output_device = x.device if output_device is None else output_device
+
+    windows = [(top, left) for top in _tile_starts(height, tile_height, overlap)
+               for left in _tile_starts(width, tile_width, overlap)]
+    output = None
+    # the tiles form a grid and the window is separable, so the sum of the windows is separable as well
+    row_weight_sum = torch.zeros(output_height, device=output_device)
+    column_weight_sum = torch.zeros(output_width, device=output_device)
+    for top in _tile_starts(height, tile_height, overlap):
+        top_out, bottom_out = round(top * scale_height), round((top + tile_height) * scale_height)
+        row_weight_sum[top_out:bottom_out] += _blend_window(bottom_out - top_out, output_height).to(output_device)
+    for left in _tile_starts(width, tile_width, overlap):
+        left_out, right_out = round(left * scale_width), round((left + tile_width) * scale_width)
+        column_weight_sum[left_out:right_out] += _blend_window(right_out - left_out, output_width).to(output_device)
+
+    for start in range(0, len(windows), batch_size):
+        batch_windows = windows[start:start + batch_size]
+        tiles = torch.cat([x[:, :, top:top + tile_height, left:left + tile_width] for top, left in batch_windows])
+        if flip:
+            tiles = torch.cat([tiles, tiles.flip(3)])
+        y = model(tiles)
+        if flip:
+            y, y_flip = y.chunk(2)
+            y = (y + y_flip.flip(3)) / 2
+        if output is None:
+            output = torch.zeros(n, y.size(1), output_height, output_width, dtype=y.dtype, device=output_device)
+
+        for i, (top, left) in enumerate(batch_windows):
+            top_out, bottom_out = round(top * scale_height), round((top + tile_height) * scale_height)
+            left_out, right_out = round(left * scale_width), round((left + tile_width) * scale_width)
+            window = _blend_window(bottom_out - top_out, output_height)[:, None] * \
+                _blend_window(right_out - left_out, output_width)[None, :]
+            window = window.to(device=output_device, dtype=y.dtype)
+            # upsample a few classes at a time to bound the size of the upsampled tile
+            for c in range(0, y.size(1), _CLASS_CHUNK_SIZE):
+                y_tile = F.interpolate(y[i * n:(i + 1) * n, c:c + _CLASS_CHUNK_SIZE],
+                                       size=(bottom_out - top_out, right_out - left_out),
+                                       mode='bilinear', align_corners=align_corners)
+                output[:, c:c + _CLASS_CHUNK_SIZE, top_out:bottom_out, left_out:right_out].addcmul_(
+                    y_tile.to(output_device), window)
+    return output.div_(row_weight_sum[:, None]).div_(column_weight_sum)
+
+
+_CLASS_CHUNK_SIZE = 4
+
+
+def _tile_starts(size: int, tile: int, overlap: float):
+    stride = max(int(tile * (1 - overlap)), 1)
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def _blend_window(size: int, full_size: int) -> torch.Tensor:
+    if size >= full_size:
+        return torch.ones(size)
+    position = torch.arange(size, dtype=torch.float)
+    return torch.min(position + 1, size - position) / ((size + 1) // 2)
@@ -1,8 +1,9 @@
-from typing import Optional
+from typing import Optional, Any, Tuple
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd import Function
 
 from common.modules.classifier import Classifier as ClassifierBase
 from common.utils.metric import binary_accuracy
@@ -36,15 +37,30 @@ class ConditionalDomainAdversarialLoss(nn.Module):
         num_classes (int, optional): Number of classes. Default: -1
         features_dim (int, optional): Dimension of input features. Default: -1
         randomized_dim (int, optional): Dimension of features after randomized. Default: 1024
+        factorized (bool, optional): If True, fuse `multi linear map` with the first layer of
+          :attr:`domain_discriminator` through :class:`FactorizedMultiLinearMap`, which never materializes the
+          :math:`(minibatch, F \times C)` input of the discriminator. The loss is the same as the
+          `multi linear map`. Ignored when `randomized` is True. Default: False
         reduction (str, optional): Specifies the reduction to apply to the output:
           ``'none'`` | ``'mean'`` | ``'sum'``. ``'none'``: no reduction will be applied,
           ``'mean'``: the sum of the output will be divided by the number of
           elements in the output, ``'sum'``: the output will be summed. Default: ``'mean'``
+        compute_accuracy (bool, optional): If False, :attr:`domain_discriminator_accuracy` is not tracked and
+          stays None. Default: True
+
+    .. note::
+        :attr:`domain_discriminator_accuracy` is evaluated lazily from the last call the first time it is read,
+        so a training step which does not read it does not pay for it.
 
     .. note::
         You need to provide `num_classes`, `features_dim` and `randomized_dim` **only when** `randomized`
         is set True.
 
+    .. note::
+        When `factorized` is set True, the first module of `domain_discriminator` must be a
+        :class:`~torch.nn.Linear` layer with :math:`F \times C` input features, e.g.
+        :class:`~dalib.modules.domain_discriminator.DomainDiscriminator`.
+
     Inputs:
         - g_s (tensor): unnormalized classifier predictions on source domain, :math:`g^s`
         - f_s (tensor): feature representations on source domain, :math:`f^s`
@@ -76,7 +92,8 @@ class ConditionalDomainAdversarialLoss(nn.Module):
     def __init__(self, domain_discriminator: nn.Module, entropy_conditioning: Optional[bool] = False,
                  randomized: Optional[bool] = False, num_classes: Optional[int] = -1,
                  features_dim: Optional[int] = -1, randomized_dim: Optional[int] = 1024,
-                 reduction: Optional[str] = 'mean'):
+                 reduction: Optional[str] = 'mean', factorized: Optional[bool] = False,
+                 compute_accuracy: Optional[bool] = True):
         super(ConditionalDomainAdversarialLoss, self).__init__()
         self.domain_discriminator = domain_discriminator
         self.grl = WarmStartGradientReverseLayer(alpha=1., lo=0., hi=1., max_iters=1000, auto_step=True)
@@ -85,28 +102,47 @@ class ConditionalDomainAdversarialLoss(nn.Module):
         if randomized:
             assert num_classes > 0 and features_dim > 0 and randomized_dim > 0
             self.map = RandomizedMultiLinearMap(features_dim, num_classes, randomized_dim)
+        elif factorized:
+            assert isinstance(domain_discriminator[0], nn.Linear)
+            self.map = FactorizedMultiLinearMap()
         else:
             self.map = MultiLinearMap()
 
         self.bce = lambda input, target, weight: F.binary_cross_entropy(input, target, weight,
                                                                         reduction=reduction) if self.entropy_conditioning \
             else F.binary_cross_entropy(input, target, reduction=reduction)
-        self.domain_discriminator_accuracy = None
+        self.compute_accuracy = compute_accuracy
+        self._accuracy_inputs = None
+        self._domain_discriminator_accuracy = None
+
+    @property
+    def domain_discriminator_accuracy(self) -> Optional[torch.Tensor]:
+        if self._accuracy_inputs is not None:
+            self._domain_discriminator_accuracy = binary_accuracy(*self._accuracy_inputs)
+            self._accuracy_inputs = None
+        return self._domain_discriminator_accuracy
 
     def forward(self, g_s: torch.Tensor, f_s: torch.Tensor, g_t: torch.Tensor, f_t: torch.Tensor) -> torch.Tensor:
         f = torch.cat((f_s, f_t), dim=0)
         g = torch.cat((g_s, g_t), dim=0)
         g = F.softmax(g, dim=1).detach()
-        h = self.grl(self.map(f, g))
-        d = self.domain_discriminator(h)
+        if isinstance(self.map, FactorizedMultiLinearMap):
+            # the map is linear in f and g is detached, so reversing the gradient of f is equivalent
+            d = self.map(self.grl(f), g, self.domain_discriminator[0])
+            for module in list(self.domain_discriminator)[1:]:
+                d = module(d)
+        else:
+            h = self.grl(self.map(f, g))
+            d = self.domain_discriminator(h)
         d_label = torch.cat((
-            torch.ones((g_s.size(0), 1)).to(g_s.device),
-            torch.zeros((g_t.size(0), 1)).to(g_t.device),
+            d.new_ones((g_s.size(0), 1)),
+            d.new_zeros((g_t.size(0), 1)),
         ))
         weight = 1.0 + torch.exp(-entropy(g))
         batch_size = f.size(0)
         weight = weight / torch.sum(weight) * batch_size
-        self.domain_discriminator_accuracy = binary_accuracy(d, d_label)
+        if self.compute_accuracy:
+            self._accuracy_inputs = (d.detach(), d_label)
         return self.bce(d, d_label, weight.view_as(d))
 
 
@@ -119,12 +155,18 @@ class RandomizedMultiLinearMap(nn.Module):
         T_{\odot}(f,g) = \dfrac{1}{\sqrt{d}} (R_f f) \odot (R_g g),
 
     where :math:`\odot` is element-wise product, :math:`R_f` and :math:`R_g` are random matrices
-    sampled only once and ﬁxed in training.
+    sampled only once and ﬁxed in training. They are registered as buffers, so they are moved to the device
+    together with the module and saved in its ``state_dict``.
+
+    When :attr:`sparse` is True, :math:`R_f` is a sparse sketch with a single non-zero entry
+    :math:`\pm\sqrt{d}` in each row (with a random column and sign). Its entries have the same mean and variance
+    as the Gaussian ones, and :math:`R_f f` costs :math:`O(F)` instead of :math:`O(F d)` per sample.
 
     Args:
         features_dim (int): dimension of input :math:`f`
         num_classes (int): dimension of input :math:`g`
         output_dim (int, optional): dimension of output tensor. Default: 1024
+        sparse (bool, optional): If True, use a sparse sketch as :math:`R_f`. Default: False
 
     Shape:
         - f: (minibatch, features_dim)
@@ -132,18 +174,41 @@ class RandomizedMultiLinearMap(nn.Module):
         - Outputs: (minibatch, output_dim)
     """
 
-    def __init__(self, features_dim: int, num_classes: int, output_dim: Optional[int] = 1024):
+    def __init__(self, features_dim: int, num_classes: int, output_dim: Optional[int] = 1024,
+                 sparse: Optional[bool] = False):
         super(RandomizedMultiLinearMap, self).__init__()
-        self.Rf = torch.randn(features_dim, output_dim)
-        self.Rg = torch.randn(num_classes, output_dim)
+        self.sparse = sparse
+        if sparse:
+            # column and sign of the single non-zero entry in each row of Rf
+            self.register_buffer('Rf_index', torch.randint(output_dim, (features_dim,)))
+            self.register_buffer('Rf_sign', torch.randint(2, (features_dim,)).float() * 2 - 1)
+        else:
+            self.register_buffer('Rf', torch.randn(features_dim, output_dim))
+        self.register_buffer('Rg', torch.randn(num_classes, output_dim))
         self.output_dim = output_dim
 
     def forward(self, f: torch.Tensor, g: torch.Tensor) -> torch.Tensor:
-        f = torch.mm(f, self.Rf.to(f.device))
-        g = torch.mm(g, self.Rg.to(g.device))
+        if self.sparse:
+            f = f.new_zeros(f.size(0), self.output_dim).index_add(
+                1, self.Rf_index, f * self.Rf_sign) * np.sqrt(float(self.output_dim))
+        else:
+            f = torch.mm(f, self.Rf)
+        g = torch.mm(g, self.Rg)
         output = torch.mul(f, g) / np.sqrt(float(self.output_dim))
         return output
 
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, *args, **kwargs):
+        super(RandomizedMultiLinearMap, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                                    missing_keys, *args, **kwargs)
+        # checkpoints saved before the random matrices became buffers do not contain them,
+        # keep the ones sampled at construction in that case
+        for name in self._buffers:
+            if prefix + name in missing_keys:
+                missing_keys.remove(prefix + name)
+
+    def extra_repr(self) -> str:
+        return 'output_dim={}, sparse={}'.format(self.output_dim, self.sparse)
+
 
 class MultiLinearMap(nn.Module):
     """Multi linear map
@@ -163,6 +228,93 @@ class MultiLinearMap(nn.Module):
         return output.view(batch_size, -1)
 
 
+class FactorizedMultiLinearFunction(Function):
+
+    @staticmethod
+    def forward(ctx: Any, f: torch.Tensor, g: torch.Tensor, weight: torch.Tensor, bias: Optional[torch.Tensor],
+                chunk_size: int) -> torch.Tensor:
+        ctx.save_for_backward(f, g, weight)
+        ctx.has_bias = bias is not None
+        ctx.chunk_size = chunk_size
+        batch_size, num_classes = g.shape
+        weight = weight.view(weight.size(0), num_classes, -1)  # H x C x F
+        output = f.new_zeros((batch_size, weight.size(0))) if bias is None else bias.expand(batch_size, -1).clone()
+        for start in range(0, num_classes, chunk_size):
+            chunk_weight = weight[:, start:start + chunk_size]  # H x k x F
+            chunk_g = g[:, start:start + chunk_size]  # B x k
+            # B x F @ F x (H * k) -> B x H x k
+            projection = torch.mm(f, chunk_weight.reshape(-1, f.size(1)).t()).view(batch_size, -1, chunk_g.size(1))
+            output += torch.bmm(projection, chunk_g.unsqueeze(2)).squeeze(2)
+        return output
+
+    @staticmethod
+    def backward(ctx: Any, grad_output: torch.Tensor) -> Tuple[Optional[torch.Tensor], ...]:
+        f, g, weight = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        batch_size, num_classes = g.shape
+        out_features = weight.size(0)
+        weight = weight.view(out_features, num_classes, -1)  # H x C x F
+        grad_f = torch.zeros_like(f) if ctx.needs_input_grad[0] else None
+        grad_g = torch.zeros_like(g) if ctx.needs_input_grad[1] else None
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[2] else None
+        grad_bias = grad_output.sum(dim=0) if ctx.has_bias and ctx.needs_input_grad[3] else None
+
+        for start in range(0, num_classes, chunk_size):
+            chunk_weight = weight[:, start:start + chunk_size].reshape(-1, f.size(1))  # (H * k) x F
+            chunk_g = g[:, start:start + chunk_size]  # B x k
+            # gradient w.r.t. the input of the chunk: B x (H * k)
+            grad_chunk = (grad_output.unsqueeze(2) * chunk_g.unsqueeze(1)).view(batch_size, -1)
+            if grad_f is not None:
+                grad_f += torch.mm(grad_chunk, chunk_weight)
+            if grad_weight is not None:
+                grad_weight[:, start:start + chunk_size] = torch.mm(grad_chunk.t(), f).view(
+                    out_features, -1, f.size(1))
+            if grad_g is not None:
+                projection = torch.mm(f, chunk_weight.t()).view(batch_size, out_features, -1)
+                grad_g[:, start:start + chunk_size] = torch.bmm(grad_output.unsqueeze(1), projection).squeeze(1)
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.view(out_features, -1)
+        return grad_f, grad_g, grad_weight, grad_bias, None
+
+
+class FactorizedMultiLinearMap(nn.Module):
+    r"""Multi linear map fused with the first linear layer of the domain discriminator
+
+    Given a linear layer with weight :math:`W \in R^{H \times (C F)}` and bias :math:`b`, computes the same output as
+    ``linear(MultiLinearMap()(f, g))``, i.e.
+
+    .. math::
+        h_k = \sum_{c=1}^{C} g_c \sum_{i=1}^{F} W_{k, c F + i} f_i + b_k,
+
+    by contracting :math:`f` with the weight reshaped to :math:`(H, C, F)`, a few classes at a time. Neither
+    the :math:`(minibatch, F \times C)` outer product nor its gradient is ever materialized, and only
+    :math:`f` and :math:`g` are kept for backward.
+
+    Args:
+        chunk_size (int, optional): Number of classes contracted at once, which trades memory of the
+          :math:`(minibatch, H, chunk\_size)` intermediate tensor for fewer kernel launches. Default: 8
+
+    Inputs:
+        - f (tensor): feature representations
+        - g (tensor): classifier predictions
+        - linear (torch.nn.Linear): the first layer of the domain discriminator with :math:`F \times C` input features
+
+    Shape:
+        - f: (minibatch, F)
+        - g: (minibatch, C)
+        - Outputs: (minibatch, H)
+    """
+
+    def __init__(self, chunk_size: Optional[int] = 8):
+        super(FactorizedMultiLinearMap, self).__init__()
+        self.chunk_size = chunk_size
+
+    def forward(self, f: torch.Tensor, g: torch.Tensor, linear: nn.Linear) -> torch.Tensor:
+        assert linear.in_features == f.size(1) * g.size(1)
+        return FactorizedMultiLinearFunction.apply(f, g, linear.weight, linear.bias, self.chunk_size)
+
+
 class ImageClassifier(ClassifierBase):
     def __init__(self, backbone: nn.Module, num_classes: int, bottleneck_dim: Optional[int] = 256, **kwargs):
         bottleneck = nn.Sequential(
@@ -1,8 +1,11 @@
 from typing import Optional, Sequence
+import functools
 import torch
 import torch.nn as nn
 
 from common.modules.classifier import Classifier as ClassifierBase
+from ..modules.kernels import GaussianKernelBank, RandomFourierFeatures
+from ..modules.memory import FeatureMemory
 
 
 __all__ = ['MultipleKernelMaximumMeanDiscrepancy', 'ImageClassifier']
@@ -35,9 +38,35 @@ class MultipleKernelMaximumMeanDiscrepancy(nn.Module):
         &+ \dfrac{1}{n_t^2} \sum_{i=1}^{n_t}\sum_{j=1}^{n_t} k(z_i^{t}, z_j^{t})\\
         &- \dfrac{2}{n_s n_t} \sum_{i=1}^{n_s}\sum_{j=1}^{n_t} k(z_i^{s}, z_j^{t}).\\
 
+    When :attr:`random_features` is ``True``, each Gaussian kernel :math:`k_u` is approximated by
+    :class:`~dalib.modules.kernels.RandomFourierFeatures` :math:`z_u`, and MK-MMD is estimated in
+    :math:`O(n D)` time and memory as
+
+    .. math::
+        \hat{D}_k(P, Q) = \sum_{u=1}^{m} \| \dfrac{1}{n_s} \sum_{i=1}^{n_s} z_u(z_i^s)
+        - \dfrac{1}{n_t} \sum_{j=1}^{n_t} z_u(z_j^t) \|^2.
+
+    When :attr:`memory_size` is positive, the detached activations of the last mini-batches of each domain are
+    kept in a :class:`~dalib.modules.memory.FeatureMemory` and used as additional samples :math:`z^s, z^t`
+    (gradients only flow through the current mini-batch). This gives a more stable estimate from a larger effective
+    sample size without growing the mini-batch forwarded through the backbone.
+    The memory is only updated in training mode.
+
     Args:
         kernels (tuple(torch.nn.Module)): kernel functions.
         linear (bool): whether use the linear version of DAN. Default: False
+        random_features (bool, optional): If True, use the random fourier features estimator.
+          Only available for :class:`~dalib.modules.kernels.GaussianKernel`. Default: False
+        random_features_dim (int, optional): Dimension :math:`D` of the random fourier features. Default: 1024
+        memory_size (int, optional): Number of past activations kept for each domain. Not available for the
+          linear version. Default: 0
+        max_staleness (int, optional): Activations kept in memory for more than :attr:`max_staleness` steps are not
+          used. If None, all activations in memory are used. Default: None
+
+    .. note::
+        :attr:`linear` is ignored when :attr:`random_features` is ``True``.
+        Unlike the kernel estimators, the random features estimator does not add :math:`\frac{2}{n-1}`
+        to the loss, which is always non-negative.
 
     Inputs:
         - z_s (tensor): activations from the source domain, :math:`z^s`
@@ -51,7 +80,8 @@ class MultipleKernelMaximumMeanDiscrepancy(nn.Module):
         Activations :math:`z^{s}` and :math:`z^{t}` must have the same shape.
 
     .. note::
-        The kernel values will add up when there are multiple kernels.
+        The kernel values will add up when there are multiple kernels. Gaussian kernels share a single
+        computation of the pairwise distances through :class:`~dalib.modules.kernels.GaussianKernelBank`.
 
     Examples::
 
@@ -65,56 +95,114 @@ class MultipleKernelMaximumMeanDiscrepancy(nn.Module):
         >>> output = loss(z_s, z_t)
     """
 
-    def __init__(self, kernels: Sequence[nn.Module], linear: Optional[bool] = False):
+    def __init__(self, kernels: Sequence[nn.Module], linear: Optional[bool] = False,
+                 random_features: Optional[bool] = False, random_features_dim: Optional[int] = 1024,
+                 memory_size: Optional[int] = 0, max_staleness: Optional[int] = None):
         super(MultipleKernelMaximumMeanDiscrepancy, self).__init__()
         self.kernels = kernels
-        self.index_matrix = None
         self.linear = linear
+        self.random_features = random_features
+        if random_features:
+            self.random_fourier_features = RandomFourierFeatures(kernels, random_features_dim)
+        else:
+            self.kernel_bank = GaussianKernelBank(kernels)
+        if memory_size > 0:
+            assert random_features or not linear, "feature memory is not available for the linear version"
+            self.source_memory = FeatureMemory(memory_size, max_staleness)
+            self.target_memory = FeatureMemory(memory_size, max_staleness)
+        else:
+            self.source_memory = self.target_memory = None
 
     def forward(self, z_s: torch.Tensor, z_t: torch.Tensor) -> torch.Tensor:
+        if self.source_memory is not None:
+            (z_s_all,), (z_t_all,) = _extend_with_memory([z_s], self.source_memory), \
+                _extend_with_memory([z_t], self.target_memory)
+            if self.training:
+                self.source_memory.update(z_s)
+                self.target_memory.update(z_t)
+            z_s, z_t = z_s_all, z_t_all
+
         features = torch.cat([z_s, z_t], dim=0)
         batch_size = int(z_s.size(0))
-        self.index_matrix = _update_index_matrix(batch_size, self.index_matrix, self.linear).to(z_s.device)
 
+        if self.random_features:
+            return _random_features_discrepancy(self.random_fourier_features(features), batch_size)
 
-        kernel_matrix = sum([kernel(features) for kernel in self.kernels])  # Add up the matrix of each kernel
-        # Add 2 / (n-1) to make up for the value on the diagonal
-        # to ensure loss is positive in the non-linear version
-        loss = (kernel_matrix * self.index_matrix).sum() + 2. / float(batch_size - 1)
+        kernel_matrix = self.kernel_bank(features)  # Add up the matrix of each kernel
+        return _kernel_discrepancy(kernel_matrix, batch_size, self.linear)
 
-        return loss
 
-
-def _update_index_matrix(batch_size: int, index_matrix: Optional[torch.Tensor] = None,
-                         linear: Optional[bool] = True) -> torch.Tensor:
+@functools.lru_cache(maxsize=32)
+def _get_index_matrix(batch_size: int, linear: bool, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
     r"""
-    Update the `index_matrix` which convert `kernel_matrix` to loss.
-    If `index_matrix` is a tensor with shape (2 x batch_size, 2 x batch_size), then return `index_matrix`.
-    Else return a new tensor with shape (2 x batch_size, 2 x batch_size).
+    Get the `index_matrix` with shape (2 x batch_size, 2 x batch_size) which converts `kernel_matrix` to loss.
+    The matrix is built with block assignments and cached for each (batch_size, linear, device, dtype),
+    so it is created and moved to `device` only once.
     """
-    if index_matrix is None or index_matrix.size(0) != batch_size * 2:
-        index_matrix = torch.zeros(2 * batch_size, 2 * batch_size)
-        if linear:
-            for i in range(batch_size):
-                s1, s2 = i, (i + 1) % batch_size
-                t1, t2 = s1 + batch_size, s2 + batch_size
-                index_matrix[s1, s2] = 1. / float(batch_size)
-                index_matrix[t1, t2] = 1. / float(batch_size)
-                index_matrix[s1, t2] = -1. / float(batch_size)
-                index_matrix[s2, t1] = -1. / float(batch_size)
-        else:
-            for i in range(batch_size):
-                for j in range(batch_size):
-                    if i != j:
-                        index_matrix[i][j] = 1. / float(batch_size * (batch_size - 1))
-                        index_matrix[i + batch_size][j + batch_size] = 1. / float(batch_size * (batch_size - 1))
-            for i in range(batch_size):
-                for j in range(batch_size):
-                    index_matrix[i][j + batch_size] = -1. / float(batch_size * batch_size)
-                    index_matrix[i + batch_size][j] = -1. / float(batch_size * batch_size)
+    index_matrix = torch.zeros(2 * batch_size, 2 * batch_size, device=device, dtype=dtype)
+    if linear:
+        s1 = torch.arange(batch_size, device=device)
+        s2 = (s1 + 1) % batch_size
+        t1, t2 = s1 + batch_size, s2 + batch_size
+        index_matrix[s1, s2] = 1. / float(batch_size)
+        index_matrix[t1, t2] = 1. / float(batch_size)
+        index_matrix[s1, t2] = -1. / float(batch_size)
+        index_matrix[s2, t1] = -1. / float(batch_size)
+    else:
+        index_matrix[:batch_size, :batch_size] = 1. / float(batch_size * (batch_size - 1))
+        index_matrix[batch_size:, batch_size:] = 1. / float(batch_size * (batch_size - 1))
+        index_matrix.fill_diagonal_(0.)
+        index_matrix[:batch_size, batch_size:] = -1. / float(batch_size * batch_size)
+        index_matrix[batch_size:, :batch_size] = -1. / float(batch_size * batch_size)
     return index_matrix
 
 
+def _kernel_discrepancy(kernel_matrix: torch.Tensor, batch_size: int, linear: Optional[bool] = False) -> torch.Tensor:
+    r"""
+    Convert `kernel_matrix` to the (MK-MMD or JMMD) loss, where the first `batch_size` rows come from the source
+    domain and the rest come from the target domain.
+    The linear version sums `kernel_matrix` weighted by the cached `index_matrix`, and requires the same number of
+    samples from both domains. The non-linear version takes the means of the four blocks directly, leaving out the
+    diagonals of the source-source and target-target blocks.
+    """
+    num_source, num_target = batch_size, kernel_matrix.size(0) - batch_size
+    if linear:
+        assert num_source == num_target, "the linear version requires the same number of samples from both domains"
+        index_matrix = _get_index_matrix(batch_size, True, kernel_matrix.device, kernel_matrix.dtype)
+        loss = (kernel_matrix * index_matrix).sum()
+    else:
+        k_ss = kernel_matrix[:num_source, :num_source]
+        k_tt = kernel_matrix[num_source:, num_source:]
+        k_st = kernel_matrix[:num_source, num_source:]
+        k_ts = kernel_matrix[num_source:, :num_source]
+        loss = (k_ss.sum() - k_ss.diagonal().sum()) / float(num_source * (num_source - 1)) \
+            + (k_tt.sum() - k_tt.diagonal().sum()) / float(num_target * (num_target - 1)) \
+            - k_st.mean() - k_ts.mean()
+    # Add 2 / (n-1) to make up for the value on the diagonal
+    # to ensure loss is positive in the non-linear version
+    return loss + 1. / float(num_source - 1) + 1. / float(num_target - 1)
+
+
+def _extend_with_memory(z: Sequence[torch.Tensor], memory: FeatureMemory) -> Sequence[torch.Tensor]:
+    r"""
+    Append the features stored in `memory` to the activations `z` of each layer.
+    """
+    memory_z = memory()
+    if memory_z is None:
+        return z
+    return [torch.cat([layer_z, layer_memory_z.to(layer_z)], dim=0) for layer_z, layer_memory_z in zip(z, memory_z)]
+
+
+def _random_features_discrepancy(features: torch.Tensor, batch_size: int) -> torch.Tensor:
+    r"""
+    Convert random `features` with shape (K, 2 x batch_size, D) to the (MK-MMD or JMMD) loss, which is the sum
+    of squared distances between the source and target means of the features of each kernel.
+    """
+    mean_s = features[:, :batch_size].mean(dim=1)
+    mean_t = features[:, batch_size:].mean(dim=1)
+    return ((mean_s - mean_t) ** 2).sum()
+
+
 class ImageClassifier(ClassifierBase):
     def __init__(self, backbone: nn.Module, num_classes: int, bottleneck_dim: Optional[int] = 256, **kwargs):
         bottleneck = nn.Sequential(
@@ -29,6 +29,12 @@ class DomainAdversarialLoss(nn.Module):
             ``'mean'``: the sum of the output will be divided by the number of
             elements in the output, ``'sum'``: the output will be summed. Default: ``'mean'``
         grl (WarmStartGradientReverseLayer, optional): Default: None.
+        compute_accuracy (bool, optional): If False, :attr:`domain_discriminator_accuracy` is not tracked and
+          stays None. Default: True
+
+    .. note::
+        :attr:`domain_discriminator_accuracy` is evaluated lazily from the last call the first time it is read,
+        so a training step which does not read it does not pay for it.
 
     Inputs:
         - f_s (tensor): feature representations on source domain, :math:`f^s`
@@ -53,22 +59,30 @@ class DomainAdversarialLoss(nn.Module):
     """
 
     def __init__(self, domain_discriminator: nn.Module, reduction: Optional[str] = 'mean',
-                 grl: Optional = None):
+                 grl: Optional = None, compute_accuracy: Optional[bool] = True):
         super(DomainAdversarialLoss, self).__init__()
         self.grl = WarmStartGradientReverseLayer(alpha=1., lo=0., hi=1., max_iters=1000, auto_step=True) if grl is None else grl
         self.domain_discriminator = domain_discriminator
         self.bce = lambda input, target, weight: \
             F.binary_cross_entropy(input, target, weight=weight, reduction=reduction)
-        self.domain_discriminator_accuracy = None
-        
-        
+        self.compute_accuracy = compute_accuracy
+        self._accuracy_inputs = None
+        self._domain_discriminator_accuracy = None
+
+    @property
+    def domain_discriminator_accuracy(self) -> Optional[torch.Tensor]:
+        if self._accuracy_inputs is not None:
+            self._domain_discriminator_accuracy = binary_accuracy(*self._accuracy_inputs)
+            self._accuracy_inputs = None
+        return self._domain_discriminator_accuracy
+
     def forward(self, f: torch.Tensor, domain_labels: torch.Tensor, w: Optional[torch.Tensor] = None) -> torch.Tensor:
         f = self.grl(f)
         d = self.domain_discriminator(f)
-        self.domain_discriminator_accuracy = binary_accuracy(d, domain_labels)
-        if w is None:
-            w = torch.ones_like(d)
-        return self.bce(d, domain_labels.reshape(d.shape), w.reshape(d.shape))
+        if self.compute_accuracy:
+            self._accuracy_inputs = (d.detach(), domain_labels)
+        # without instance weights, the loss is the same as with a weight of ones
+        return self.bce(d, domain_labels.reshape(d.shape), None if w is None else w.reshape(d.shape))
 
     # def forward(self, f_s: torch.Tensor, f_t: torch.Tensor,
     #             w_s: Optional[torch.Tensor] = None, w_t: Optional[torch.Tensor] = None) -> torch.Tensor:
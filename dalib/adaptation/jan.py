@@ -4,8 +4,9 @@ import torch.nn as nn
 
 from common.modules.classifier import Classifier as ClassifierBase
 from ..modules.grl import GradientReverseLayer
-from ..modules.kernels import GaussianKernel
-from .dan import _update_index_matrix
+from ..modules.kernels import GaussianKernel, GaussianKernelBank, RandomFourierFeatures
+from ..modules.memory import FeatureMemory
+from .dan import _kernel_discrepancy, _random_features_discrepancy, _extend_with_memory
 
 
 __all__ = ['JointMultipleKernelMaximumMeanDiscrepancy', 'ImageClassifier']
@@ -29,10 +30,25 @@ class JointMultipleKernelMaximumMeanDiscrepancy(nn.Module):
         &+ \dfrac{1}{n_t^2} \sum_{i=1}^{n_t}\sum_{j=1}^{n_t} \prod_{l\in\mathcal{L}} k^l(z_i^{tl}, z_j^{tl}) \\
         &- \dfrac{2}{n_s n_t} \sum_{i=1}^{n_s}\sum_{j=1}^{n_t} \prod_{l\in\mathcal{L}} k^l(z_i^{sl}, z_j^{tl}). \\
 
+    When :attr:`random_features` is ``True``, the product kernel of every combination of Gaussian kernels
+    across layers is approximated by :class:`~dalib.modules.kernels.RandomFourierFeatures` on the concatenated
+    activations, and :math:`\hat{D}_{\mathcal{L}}(P, Q)` is estimated in :math:`O(n D)` time and memory
+    as the squared distance between the source and target means of the random features.
+
     Args:
         kernels (tuple(tuple(torch.nn.Module))): kernel functions, where `kernels[r]` corresponds to kernel :math:`k^{\mathcal{L}[r]}`.
         linear (bool): whether use the linear version of JAN. Default: False
         thetas (list(Theta): use adversarial version JAN if not None. Default: None
+        random_features (bool, optional): If True, use the random fourier features estimator.
+          Only available for :class:`~dalib.modules.kernels.GaussianKernel`. Default: False
+        random_features_dim (int, optional): Dimension :math:`D` of the random fourier features. Default: 1024
+        memory_size (int, optional): Number of past activations kept for each domain, which are used as additional
+          samples. See :class:`~dalib.adaptation.dan.MultipleKernelMaximumMeanDiscrepancy`. Default: 0
+        max_staleness (int, optional): Activations kept in memory for more than :attr:`max_staleness` steps are not
+          used. If None, all activations in memory are used. Default: None
+
+    .. note::
+        :attr:`linear` is ignored when :attr:`random_features` is ``True``.
 
     Inputs:
         - z_s (tuple(tensor)): multiple layers' activations from the source domain, :math:`z^s`
@@ -46,7 +62,9 @@ class JointMultipleKernelMaximumMeanDiscrepancy(nn.Module):
         Activations :math:`z^{sl}` and :math:`z^{tl}` must have the same shape.
 
     .. note::
-        The kernel values will add up when there are multiple kernels for a certain layer.
+        The kernel values will add up when there are multiple kernels for a certain layer. Gaussian kernels of
+        the same layer share a single computation of the pairwise distances through
+        :class:`~dalib.modules.kernels.GaussianKernelBank`.
 
     Examples::
 
@@ -62,31 +80,62 @@ class JointMultipleKernelMaximumMeanDiscrepancy(nn.Module):
         >>> output = loss((z1_s, z2_s), (z1_t, z2_t))
     """
 
-    def __init__(self, kernels: Sequence[Sequence[nn.Module]], linear: Optional[bool] = True, thetas: Sequence[nn.Module] = None):
+    def __init__(self, kernels: Sequence[Sequence[nn.Module]], linear: Optional[bool] = True, thetas: Sequence[nn.Module] = None,
+                 random_features: Optional[bool] = False, random_features_dim: Optional[int] = 1024,
+                 memory_size: Optional[int] = 0, max_staleness: Optional[int] = None):
         super(JointMultipleKernelMaximumMeanDiscrepancy, self).__init__()
         self.kernels = kernels
-        self.index_matrix = None
         self.linear = linear
+        self.random_features = random_features
+        if random_features:
+            self.random_fourier_features = nn.ModuleList(
+                [RandomFourierFeatures(layer_kernels, random_features_dim) for layer_kernels in kernels])
+        else:
+            self.kernel_banks = [GaussianKernelBank(layer_kernels) for layer_kernels in kernels]
+        if memory_size > 0:
+            assert random_features or not linear, "feature memory is not available for the linear version"
+            self.source_memory = FeatureMemory(memory_size, max_staleness)
+            self.target_memory = FeatureMemory(memory_size, max_staleness)
+        else:
+            self.source_memory = self.target_memory = None
         if thetas:
             self.thetas = thetas
         else:
             self.thetas = [nn.Identity() for _ in kernels]
 
     def forward(self, z_s: torch.Tensor, z_t: torch.Tensor) -> torch.Tensor:
+        if self.source_memory is not None:
+            z_s_all, z_t_all = _extend_with_memory(z_s, self.source_memory), \
+                _extend_with_memory(z_t, self.target_memory)
+            if self.training:
+                self.source_memory.update(*z_s)
+                self.target_memory.update(*z_t)
+            z_s, z_t = z_s_all, z_t_all
+
         batch_size = int(z_s[0].size(0))
-        self.index_matrix = _update_index_matrix(batch_size, self.index_matrix, self.linear).to(z_s[0].device)
 
-        kernel_matrix = torch.ones_like(self.index_matrix)
-        for layer_z_s, layer_z_t, layer_kernels, theta in zip(z_s, z_t, self.kernels, self.thetas):
+        if self.random_features:
+            # The product of Gaussian kernels is a Gaussian kernel on the concatenated activations,
+            # so the projections of each combination of kernels across layers are summed up.
+            projection = None
+            for layer_z_s, layer_z_t, layer_random_features, theta in \
+                    zip(z_s, z_t, self.random_fourier_features, self.thetas):
+                layer_features = theta(torch.cat([layer_z_s, layer_z_t], dim=0))
+                layer_projection = layer_random_features.project(layer_features)
+                if projection is None:
+                    projection = layer_projection
+                else:
+                    projection = (projection.unsqueeze(1) + layer_projection.unsqueeze(0)).flatten(0, 1)
+            features = self.random_fourier_features[0].features(projection)
+            return _random_features_discrepancy(features, batch_size)
+
+        kernel_matrix = 1.
+        for layer_z_s, layer_z_t, layer_kernel_bank, theta in zip(z_s, z_t, self.kernel_banks, self.thetas):
             layer_features = torch.cat([layer_z_s, layer_z_t], dim=0)
             layer_features = theta(layer_features)
-            kernel_matrix *= sum(
-                [kernel(layer_features) for kernel in layer_kernels])  # Add up the matrix of each kernel
+            kernel_matrix = kernel_matrix * layer_kernel_bank(layer_features)  # Add up the matrix of each kernel
 
-        # Add 2 / (n-1) to make up for the value on the diagonal
-        # to ensure loss is positive in the non-linear version
-        loss = (kernel_matrix * self.index_matrix).sum() + 2. / float(batch_size - 1)
-        return loss
+        return _kernel_discrepancy(kernel_matrix, batch_size, self.linear)
 
 
 class Theta(nn.Module):
@@ -1,10 +1,8 @@
 from typing import Optional
 import torch
 import torch.nn as nn
-import numpy as np
 
 from ...modules.gl import WarmStartGradientLayer
-from common.utils.metric.keypoint_detection import get_max_preds
 
 
 class PseudoLabelGenerator(nn.Module):
@@ -32,50 +30,32 @@ class PseudoLabelGenerator(nn.Module):
     """
     def __init__(self, num_keypoints, height=64, width=64, sigma=2):
         super(PseudoLabelGenerator, self).__init__()
+        self.num_keypoints = num_keypoints
         self.height = height
         self.width = width
         self.sigma = sigma
 
-        heatmaps = np.zeros((width, height, height, width), dtype=np.float32)
-
-        tmp_size = sigma * 3
-        for mu_x in range(width):
-            for mu_y in range(height):
-                # Check that any part of the gaussian is in-bounds
-                ul = [int(mu_x - tmp_size), int(mu_y - tmp_size)]
-                br = [int(mu_x + tmp_size + 1), int(mu_y + tmp_size + 1)]
-
-                # Generate gaussian
-                size = 2 * tmp_size + 1
-                x = np.arange(0, size, 1, np.float32)
-                y = x[:, np.newaxis]
-                x0 = y0 = size // 2
-                # The gaussian is not normalized, we want the center value to equal 1
-                g = np.exp(- ((x - x0) ** 2 + (y - y0) ** 2) / (2 * sigma ** 2))
-
-                # Usable gaussian range
-                g_x = max(0, -ul[0]), min(br[0], width) - ul[0]
-                g_y = max(0, -ul[1]), min(br[1], height) - ul[1]
-                # Image range
-                img_x = max(0, ul[0]), min(br[0], width)
-                img_y = max(0, ul[1]), min(br[1], height)
-
-                heatmaps[mu_x][mu_y][img_y[0]:img_y[1], img_x[0]:img_x[1]] = \
-                    g[g_y[0]:g_y[1], g_x[0]:g_x[1]]
-
-        self.heatmaps = heatmaps
-        self.false_matrix = 1. - np.eye(num_keypoints, dtype=np.float32)
-
     def forward(self, y):
         B, K, H, W = y.shape
         y = y.detach()
-        preds, max_vals = get_max_preds(y.cpu().numpy())  # B x K x (x, y)
-        preds = preds.reshape(-1, 2).astype(np.int)
-        ground_truth = self.heatmaps[preds[:, 0], preds[:, 1], :, :].copy().reshape(B, K, H, W).copy()
-
-        ground_false = ground_truth.reshape(B, K, -1).transpose((0, 2, 1))
-        ground_false = ground_false.dot(self.false_matrix).clip(max=1., min=0.).transpose((0, 2, 1)).reshape(B, K, H, W).copy()
-        return torch.from_numpy(ground_truth).to(y.device), torch.from_numpy(ground_false).to(y.device)
+        max_vals, idx = y.reshape(B, K, -1).max(dim=2)
+        # keypoints whose maximum is not positive are put at (0, 0), as in get_max_preds
+        idx = idx * (max_vals > 0).long()
+        mu_x = (idx % W).view(B, K, 1, 1).float()
+        mu_y = (idx // W).view(B, K, 1, 1).float()
+
+        # the gaussian is not normalized and is cut beyond 3 sigma, we want the center value to equal 1.
+        # It is separable, so it is rendered as the outer product of a row and a column.
+        dx = torch.arange(W, device=y.device, dtype=torch.float32).view(1, 1, 1, W) - mu_x
+        dy = torch.arange(H, device=y.device, dtype=torch.float32).view(1, 1, H, 1) - mu_y
+        tmp_size = self.sigma * 3
+        g_x = torch.exp(- dx ** 2 / (2 * self.sigma ** 2)) * (dx.abs() <= tmp_size).float()
+        g_y = torch.exp(- dy ** 2 / (2 * self.sigma ** 2)) * (dy.abs() <= tmp_size).float()
+        ground_truth = g_y * g_x
+
+        # the ground false heatmap of a keypoint is the sum of the ground truth heatmaps of the other keypoints
+        ground_false = (ground_truth.sum(dim=1, keepdim=True) - ground_truth).clamp(min=0., max=1.)
+        return ground_truth, ground_false
 
 
 class RegressionDisparity(nn.Module):
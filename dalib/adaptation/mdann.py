@@ -28,6 +28,12 @@ class MultidomainAdversarialLoss(nn.Module):
             ``'mean'``: the sum of the output will be divided by the number of
             elements in the output, ``'sum'``: the output will be summed. Default: ``'mean'``
         grl (WarmStartGradientReverseLayer, optional): Default: None.
+        compute_accuracy (bool, optional): If False, :attr:`domain_discriminator_accuracy` is not tracked and
+          stays None. Default: True
+
+    .. note::
+        :attr:`domain_discriminator_accuracy` is evaluated lazily from the last call the first time it is read,
+        so a training step which does not read it does not pay for it.
 
     Inputs:
         - f_s (tensor): feature representations on source(s), :math:`f^s`
@@ -55,7 +61,7 @@ class MultidomainAdversarialLoss(nn.Module):
     """
 
     def __init__(self, multidomain_discriminator: nn.Module, reduction: Optional[str] = 'mean',
-                 grl: Optional = None):
+                 grl: Optional = None, compute_accuracy: Optional[bool] = True):
         super(MultidomainAdversarialLoss, self).__init__()
         self.grl = WarmStartGradientReverseLayer(
             alpha=1., lo=0., hi=1., max_iters=1000, auto_step=True) if grl is None else grl
@@ -64,7 +70,16 @@ class MultidomainAdversarialLoss(nn.Module):
             F.cross_entropy(
                 input, target, weight=weight, reduction=reduction
             )
-        self.domain_discriminator_accuracy = None
+        self.compute_accuracy = compute_accuracy
+        self._accuracy_inputs = None
+        self._domain_discriminator_accuracy = None
+
+    @property
+    def domain_discriminator_accuracy(self) -> Optional[torch.Tensor]:
+        if self._accuracy_inputs is not None:
+            self._domain_discriminator_accuracy = accuracy(*self._accuracy_inputs)[0]
+            self._accuracy_inputs = None
+        return self._domain_discriminator_accuracy
 
     def forward(self, f: torch.Tensor, d_labels: torch.Tensor, 
                 w: Optional[torch.Tensor] = None, grl_input: Optional[Any] = None, custom_loss: Optional[Any] = None) -> torch.Tensor:
@@ -73,9 +88,9 @@ class MultidomainAdversarialLoss(nn.Module):
         else:
             f = self.grl(f)
         self.domain_pred = self.multidomain_discriminator(f)
-        self.domain_discriminator_accuracy = accuracy(self.domain_pred, d_labels)[0]
-        if w is None:
-            w = torch.ones((self.domain_pred.shape[-1], 1)).to(f.device)
+        if self.compute_accuracy:
+            self._accuracy_inputs = (self.domain_pred.detach(), d_labels)
+        # without class weights (w is None), the loss is the same as with a weight of ones
         if custom_loss:
             return custom_loss(self.domain_pred)
         return self.loss(self.domain_pred, d_labels, w)
@@ -1,4 +1,6 @@
 from typing import Optional, List, Tuple
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from torch.utils.data.dataloader import DataLoader
 import torch.nn as nn
@@ -21,6 +23,20 @@ class AutomaticUpdateClassWeightModule(object):
         partial_classes_index (list[int], optional): The index of partial classes. Note that this parameter is \
           just for debugging, since in real-world dataset, we have no access to the index of partial classes. \
           Default: None.
+        momentum (float, optional): If not None, the class weight is estimated incrementally from the classification
+          outputs of the target mini-batches passed to :meth:`step`, as an exponential moving average of
+          :math:`softmax(\hat{y} / T)` with this momentum, instead of a full pass over `data_loader`
+          every N iterations. Default: None
+        background (bool, optional): If True, the full pass over `data_loader` every N iterations runs in a
+          background thread on a copy of `classifier` taken at that iteration, and the class weight is updated once
+          it finishes, instead of stalling training. Default: False
+
+    .. note::
+        The incremental estimate is cheap but follows the classifier with a lag of about :math:`1 / (1 - momentum)`
+        iterations, and is noisier than a full pass, while a background pass is exact for a model which is
+        :attr:`staleness` iterations old when its result is used. When both are enabled, each background pass
+        replaces the moving average and :attr:`incremental_error` reports the mean absolute difference between
+        the incremental estimate and the full pass.
 
     Examples::
 
@@ -37,7 +53,8 @@ class AutomaticUpdateClassWeightModule(object):
     def __init__(self, update_steps: int, data_loader: DataLoader,
                  classifier: nn.Module, num_classes: int,
                  device: torch.device, temperature: Optional[float] = 0.1,
-                 partial_classes_index: Optional[List[int]] = None):
+                 partial_classes_index: Optional[List[int]] = None,
+                 momentum: Optional[float] = None, background: Optional[bool] = False):
         self.update_steps = update_steps
         self.data_loader = data_loader
         self.classifier = classifier
@@ -49,11 +66,62 @@ class AutomaticUpdateClassWeightModule(object):
         if partial_classes_index is not None:
             self.non_partial_classes_index = [c for c in range(num_classes) if c not in partial_classes_index]
 
-    def step(self):
+        self.momentum = momentum
+        # bias-corrected moving average of softmax(y / T), as in Adam
+        self._average = torch.zeros(num_classes, device=device)
+        self._average_norm = 0.
+        self.incremental_error = None
+
+        self.background = background
+        self._executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self._lagged_classifier = None
+        self._pending = None
+        self._pending_step = 0
+        self.staleness = 0
+
+    def step(self, y_t: Optional[torch.Tensor] = None):
+        """
+        Args:
+            y_t (tensor, optional): classification outputs on the current target mini-batch, required when
+              `momentum` is not None.
+        """
         self.num_steps += 1
-        if self.num_steps % self.update_steps == 0:
+        self.staleness += 1
+        if self.momentum is not None:
+            assert y_t is not None, "the incremental estimate needs the outputs on the target mini-batch"
+            softmax_outputs = F.softmax(y_t.detach() / self.class_weight_module.temperature, dim=1)
+            self._average.mul_(self.momentum).add_(softmax_outputs.mean(dim=0), alpha=1 - self.momentum)
+            self._average_norm = self._average_norm * self.momentum + 1 - self.momentum
+            class_weight = self._average / self._average_norm
+            self.class_weight = class_weight / torch.max(class_weight)
+
+        if self.background:
+            if self._pending is not None and self._pending.done():
+                self._apply_full_pass(self._pending.result(), self._pending_step)
+                self._pending = None
+            if self.num_steps % self.update_steps == 0 and self._pending is None:
+                if self._lagged_classifier is None:
+                    self._lagged_classifier = copy.deepcopy(self.classifier)
+                else:
+                    self._lagged_classifier.load_state_dict(self.classifier.state_dict())
+                self._pending = self._executor.submit(collect_classification_results, self.data_loader,
+                                                      self._lagged_classifier, self.device)
+                self._pending_step = self.num_steps
+        elif self.momentum is None and self.num_steps % self.update_steps == 0:
+            training = self.classifier.training
             all_outputs = collect_classification_results(self.data_loader, self.classifier, self.device)
-            self.class_weight = self.class_weight_module(all_outputs)
+            self.classifier.train(training)
+            self._apply_full_pass(all_outputs, self.num_steps)
+
+    def _apply_full_pass(self, all_outputs: torch.Tensor, step: int):
+        class_weight = self.class_weight_module(all_outputs)
+        if self.momentum is not None:
+            self.incremental_error = (self.class_weight - class_weight).abs().mean().item()
+            # restart the moving average from the full pass
+            self._average.copy_(F.softmax(all_outputs / self.class_weight_module.temperature, dim=1).mean(dim=0))
+            self._average_norm = 1.
+        self.class_weight = class_weight
+        self.staleness = self.num_steps - step
 
     def get_class_weight_for_cross_entropy_loss(self):
         """
@@ -112,10 +112,20 @@ class EmaTeacher(object):
     Args:
         model (torch.nn.Module): student model
         alpha (float): decay rate for EMA.
+        buffers (str, optional): How the buffers of the teacher (e.g. the running statistics of BatchNorm) follow
+          the student. ``None``: they are not updated from the student, ``'copy'``: they are copied from the student,
+          ``'ema'``: floating point buffers follow the same EMA as the parameters and the others are copied.
+          Default: ``None``
+        update_every (int, optional): Only update the teacher every `update_every` calls of :meth:`update`, with decay
+          rate :math:`\alpha^{update\_every}` so that the EMA keeps the same time scale. Default: 1
 
     Inputs:
         x (tensor): input data fed to teacher model
 
+    .. note::
+        The parameters are updated in place with multi-tensor (foreach) :math:`lerp` kernels when available, so the
+        update of the whole model only launches a handful of kernels and allocates no new tensors.
+
     Examples::
 
         >>> classifier = ImageClassifier(backbone, num_classes=31, bottleneck_dim=256).to(device)
@@ -130,15 +140,35 @@ class EmaTeacher(object):
         >>>     teacher.update()
     """
 
-    def __init__(self, model, alpha):
+    def __init__(self, model, alpha, buffers: Optional[str] = None, update_every: Optional[int] = 1):
+        assert buffers in (None, 'copy', 'ema')
+        assert update_every >= 1
         self.model = model
         self.alpha = alpha
+        self.buffers = buffers
+        self.update_every = update_every
+        self.num_steps = 0
         self.teacher = copy.deepcopy(model)
         set_requires_grad(self.teacher, False)
 
+    @torch.no_grad()
     def update(self):
-        for teacher_param, param in zip(self.teacher.parameters(), self.model.parameters()):
-            teacher_param.data = self.alpha * teacher_param + (1 - self.alpha) * param
+        self.num_steps += 1
+        if self.num_steps % self.update_every != 0:
+            return
+        weight = 1 - self.alpha ** self.update_every
+        _lerp_(list(self.teacher.parameters()), list(self.model.parameters()), weight)
+
+        if self.buffers is not None:
+            ema_buffers, copy_buffers = ([], []), ([], [])
+            for teacher_buffer, buffer in zip(self.teacher.buffers(), self.model.buffers()):
+                target = ema_buffers if self.buffers == 'ema' and buffer.is_floating_point() else copy_buffers
+                target[0].append(teacher_buffer)
+                target[1].append(buffer)
+            if len(ema_buffers[0]) > 0:
+                _lerp_(*ema_buffers, weight)
+            for teacher_buffer, buffer in zip(*copy_buffers):
+                teacher_buffer.copy_(buffer)
 
     def __call__(self, x: torch.Tensor):
         return self.teacher(x)
@@ -147,6 +177,15 @@ class EmaTeacher(object):
         self.teacher.train(mode)
 
 
+def _lerp_(tensors, ends, weight):
+    # tensors <- tensors + weight * (ends - tensors), in place
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(tensors, ends, weight)
+    else:
+        for tensor, end in zip(tensors, ends):
+            tensor.lerp_(end, weight)
+
+
 class ImageClassifier(ClassifierBase):
     def __init__(self, backbone: nn.Module, num_classes: int, bottleneck_dim: Optional[int] = 256, **kwargs):
         bottleneck = nn.Sequential(
@@ -3,6 +3,7 @@ from .domain_discriminator import *
 from .multidomain_discriminator import *
 from .kernels import *
 from .entropy import *
+from .memory import *
 
 __all__ = ['grl', 'kernels', 'domain_discriminator',
-           'multidomain_discriminator', 'entropy']
+           'multidomain_discriminator', 'entropy', 'memory']
@@ -1,9 +1,31 @@
-from typing import Optional
+from typing import Optional, Sequence
+import math
 import torch
 import torch.nn as nn
 
 
-__all__ = ['GaussianKernel']
+__all__ = ['GaussianKernel', 'GaussianKernelBank', 'RandomFourierFeatures', 'pairwise_squared_distance']
+
+
+def pairwise_squared_distance(X: torch.Tensor) -> torch.Tensor:
+    r"""Squared L2 distances between all pairs of rows in :math:`X`
+
+    The distances are computed from the Gram matrix as
+    :math:`\| x_i - x_j \|^2 = \| x_i \|^2 + \| x_j \|^2 - 2 x_i^T x_j`,
+    so that only :math:`(minibatch, minibatch)` tensors are created instead of the
+    :math:`(minibatch, minibatch, F)` tensor of all pairwise differences.
+    The features are centered first, which leaves the distances unchanged but reduces floating point
+    cancellation, and small negative values caused by the remaining cancellation are clamped to zero.
+
+    Shape:
+        - Inputs: :math:`(minibatch, F)` where F means the dimension of input features.
+        - Outputs: :math:`(minibatch, minibatch)`
+    """
+    X = X.flatten(start_dim=1)
+    X = X - X.mean(dim=0, keepdim=True)
+    square_norm = (X * X).sum(dim=1)
+    gram = torch.mm(X, X.t())
+    return torch.clamp(square_norm.unsqueeze(1) + square_norm.unsqueeze(0) - 2 * gram, min=0.)
 
 
 class GaussianKernel(nn.Module):
@@ -50,9 +72,145 @@ class GaussianKernel(nn.Module):
         self.alpha = alpha
 
     def forward(self, X: torch.Tensor) -> torch.Tensor:
-        l2_distance_square = ((X.unsqueeze(0) - X.unsqueeze(1)) ** 2).sum(2)
+        l2_distance_square = pairwise_squared_distance(X)
 
         if self.track_running_stats:
             self.sigma_square = self.alpha * torch.mean(l2_distance_square.detach())
 
-        return torch.exp(-l2_distance_square / (2 * self.sigma_square))
\ No newline at end of file
+        return torch.exp(-l2_distance_square / (2 * self.sigma_square))
+
+
+class GaussianKernelBank(nn.Module):
+    r"""Sum of multiple Gaussian Kernel Matrices with different bandwidths
+
+    Computes the same output as ``sum([kernel(X) for kernel in kernels])``, but the pairwise
+    L2 distances (and their mean, when running statistics are tracked) are computed only once
+    and shared by all the bandwidths, which are then evaluated in a single fused ``exp``.
+
+    The :math:`\sigma^2` of each :class:`GaussianKernel` is still updated during training,
+    so the kernels in the bank keep the same state as if they were called one by one.
+    Kernels which are not a :class:`GaussianKernel` are evaluated separately and added to the result.
+
+    Args:
+        kernels (tuple(torch.nn.Module)): kernel functions.
+
+    Inputs:
+        - X (tensor): input group :math:`X`
+
+    Shape:
+        - Inputs: :math:`(minibatch, F)` where F means the dimension of input features.
+        - Outputs: :math:`(minibatch, minibatch)`
+
+    Examples::
+
+        >>> kernels = [GaussianKernel(alpha=2 ** k) for k in range(-3, 2)]
+        >>> kernel_bank = GaussianKernelBank(kernels)
+        >>> X = torch.randn(20, 1024)
+        >>> output = kernel_bank(X)  # same as sum([kernel(X) for kernel in kernels])
+    """
+
+    def __init__(self, kernels: Sequence[nn.Module]):
+        super(GaussianKernelBank, self).__init__()
+        self.kernels = kernels
+        self.gaussian_kernels = [kernel for kernel in kernels if isinstance(kernel, GaussianKernel)]
+        self.other_kernels = [kernel for kernel in kernels if not isinstance(kernel, GaussianKernel)]
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        kernel_matrix = sum([kernel(X) for kernel in self.other_kernels])
+        if len(self.gaussian_kernels) == 0:
+            return kernel_matrix
+
+        l2_distance_square = pairwise_squared_distance(X)
+        mean_l2_distance_square = None
+        sigma_square = []
+        for kernel in self.gaussian_kernels:
+            if kernel.track_running_stats:
+                if mean_l2_distance_square is None:
+                    mean_l2_distance_square = torch.mean(l2_distance_square.detach())
+                kernel.sigma_square = kernel.alpha * mean_l2_distance_square
+            sigma_square.append(torch.as_tensor(kernel.sigma_square, dtype=X.dtype, device=X.device))
+        sigma_square = torch.stack(sigma_square).view(-1, 1, 1)
+
+        return kernel_matrix + torch.exp(-l2_distance_square.unsqueeze(0) / (2 * sigma_square)).sum(dim=0)
+
+
+class RandomFourierFeatures(nn.Module):
+    r"""Random Fourier Features of multiple Gaussian kernels from
+    `Random Features for Large-Scale Kernel Machines (NIPS 2007) <https://people.eecs.berkeley.edu/~brecht/papers/07.rah.rec.nips.pdf>`_
+
+    For each Gaussian kernel :math:`k_u` with bandwidth :math:`\sigma_u`, the feature map is
+
+    .. math::
+        z_u(x) = \sqrt{\dfrac{2}{D}} \cos \left( \dfrac{W x}{\sigma_u} + b \right),
+
+    where :math:`W \in R^{D \times d}` is sampled from :math:`\mathcal{N}(0, I)` and :math:`b \in R^D` is sampled
+    from :math:`\mathcal{U}(0, 2\pi)`. Both are sampled only once and ﬁxed in training. Then
+    :math:`z_u(x_1)^T z_u(x_2)` is an unbiased estimate of :math:`k_u(x_1, x_2)`, which costs :math:`O(D)` per
+    sample instead of :math:`O(minibatch)`.
+
+    The projection :math:`Wx` is shared by all the bandwidths. When a :class:`GaussianKernel` tracks running
+    statistics, its :math:`\sigma^2` is updated in the same way as :class:`GaussianKernel` does, but the mean of
+    the pairwise L2 distances is computed in :math:`O(minibatch \times d)` without forming the distance matrix.
+
+    Args:
+        kernels (tuple(GaussianKernel)): Gaussian kernel functions.
+        num_features (int, optional): dimension :math:`D` of the random features. Default: 1024
+
+    Inputs:
+        - X (tensor): input group :math:`X`
+
+    Shape:
+        - Inputs: :math:`(minibatch, d)` where d means the dimension of input features.
+        - Outputs: :math:`(K, minibatch, D)` where K means the number of kernels.
+    """
+
+    def __init__(self, kernels: Sequence[GaussianKernel], num_features: Optional[int] = 1024):
+        super(RandomFourierFeatures, self).__init__()
+        assert all(isinstance(kernel, GaussianKernel) for kernel in kernels), \
+            "random fourier features are only available for GaussianKernel"
+        self.kernels = kernels
+        self.num_features = num_features
+        # sampled lazily since the dimension of input features is only known at the first call
+        self.register_buffer('weight', None)
+        self.register_buffer('bias', None)
+
+    def project(self, X: torch.Tensor) -> torch.Tensor:
+        r"""Return :math:`W x / \sigma_u` for each kernel :math:`u`, with shape :math:`(K, minibatch, D)`."""
+        X = X.flatten(start_dim=1)
+        if self.weight is None:
+            self.weight = torch.randn(X.size(1), self.num_features, dtype=X.dtype, device=X.device)
+            self.bias = 2 * math.pi * torch.rand(self.num_features, dtype=X.dtype, device=X.device)
+
+        mean_l2_distance_square = None
+        sigma_square = []
+        for kernel in self.kernels:
+            if kernel.track_running_stats:
+                if mean_l2_distance_square is None:
+                    mean_l2_distance_square = _mean_pairwise_squared_distance(X.detach())
+                kernel.sigma_square = kernel.alpha * mean_l2_distance_square
+            sigma_square.append(torch.as_tensor(kernel.sigma_square, dtype=X.dtype, device=X.device))
+        sigma = torch.stack(sigma_square).sqrt().view(-1, 1, 1)
+
+        return torch.mm(X, self.weight).unsqueeze(0) / sigma
+
+    def features(self, projection: torch.Tensor) -> torch.Tensor:
+        r"""Map projections (or sums of projections, for product kernels) to random features."""
+        return math.sqrt(2. / self.num_features) * torch.cos(projection + self.bias)
+
+    def forward(self, X: torch.Tensor) -> torch.Tensor:
+        return self.features(self.project(X))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the random weights are created lazily, so create them before loading a checkpoint which has them
+        for name in ('weight', 'bias'):
+            if getattr(self, name) is None and prefix + name in state_dict:
+                setattr(self, name, torch.zeros_like(state_dict[prefix + name]))
+        super(RandomFourierFeatures, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def _mean_pairwise_squared_distance(X: torch.Tensor) -> torch.Tensor:
+    r"""
+    Mean of :math:`\| x_i - x_j \|^2` over all pairs :math:`(i, j)`, which equals
+    :math:`2 (\frac{1}{n} \sum_i \| x_i \|^2 - \| \bar{x} \|^2)`.
+    """
+    return 2 * ((X * X).sum(dim=1).mean() - (X.mean(dim=0) ** 2).sum())
@@ -0,0 +1,98 @@
+from typing import Optional, Tuple
+import torch
+import torch.nn as nn
+
+
+__all__ = ['FeatureMemory']
+
+
+class FeatureMemory(nn.Module):
+    r"""A fixed-size ring buffer of detached features from past mini-batches.
+
+    Each call of :meth:`update` writes the features of one mini-batch (optionally from several layers,
+    which are kept aligned sample by sample) over the oldest entries of the buffer. Calling the module returns
+    the stored features which are not stale, i.e. which were written at most :attr:`max_staleness` updates ago.
+
+    Since the stored features are detached, they can serve as additional reference samples for a
+    discrepancy loss at the cost of only :math:`(size, F)` memory per layer, without growing the
+    mini-batch forwarded through the backbone.
+
+    Args:
+        size (int): maximum number of samples stored.
+        max_staleness (int, optional): features written more than :attr:`max_staleness` updates ago are not
+          returned. If None, all the stored features are returned. Default: None
+
+    Inputs:
+        - (none)
+
+    Outputs:
+        - features (tuple(tensor)): stored features of each layer, or None if nothing is stored yet.
+
+    Shape:
+        - features[l]: :math:`(N, *)` where :math:`N \leq size` and * is the feature shape of the l-th layer.
+
+    Examples::
+
+        >>> memory = FeatureMemory(size=256, max_staleness=8)
+        >>> f, g = torch.randn(32, 1024), torch.randn(32, 31)
+        >>> memory.update(f, g)
+        >>> f_memory, g_memory = memory()
+    """
+
+    def __init__(self, size: int, max_staleness: Optional[int] = None):
+        super(FeatureMemory, self).__init__()
+        assert size > 0
+        self.size = size
+        self.max_staleness = max_staleness
+        self.num_layers = 0
+        # step at which each entry was written, -1 for empty entries
+        self.register_buffer('timestamps', torch.full((size,), -1, dtype=torch.long))
+        self.register_buffer('num_updates', torch.zeros((), dtype=torch.long))
+        self.register_buffer('num_written', torch.zeros((), dtype=torch.long))
+
+    def _layer_features(self):
+        return [getattr(self, 'features_{}'.format(i)) for i in range(self.num_layers)]
+
+    @torch.no_grad()
+    def update(self, *features: torch.Tensor):
+        """Write the (detached) features of one mini-batch, one tensor for each layer."""
+        if self.num_layers == 0:
+            self.num_layers = len(features)
+            for i, layer_features in enumerate(features):
+                self.register_buffer('features_{}'.format(i),
+                                     layer_features.new_zeros((self.size,) + layer_features.shape[1:]))
+        assert len(features) == self.num_layers
+
+        # only the last `size` samples survive when the mini-batch is larger than the memory
+        features = [layer_features.detach()[-self.size:] for layer_features in features]
+        batch_size = features[0].size(0)
+        index = (self.num_written + torch.arange(batch_size, device=self.timestamps.device)) % self.size
+        for memory_features, layer_features in zip(self._layer_features(), features):
+            memory_features.index_copy_(0, index.to(memory_features.device), layer_features.to(memory_features))
+        self.timestamps.index_copy_(0, index, self.num_updates.expand(batch_size))
+        self.num_written += batch_size
+        self.num_updates += 1
+
+    def forward(self) -> Optional[Tuple[torch.Tensor, ...]]:
+        if self.num_layers == 0:
+            return None
+        valid = self.timestamps >= 0
+        if self.max_staleness is not None:
+            valid &= (self.num_updates - self.timestamps) <= self.max_staleness
+        return tuple(memory_features[valid.to(memory_features.device)] for memory_features in self._layer_features())
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the feature buffers are created lazily, so create them before loading a non-empty memory
+        while prefix + 'features_{}'.format(self.num_layers) in state_dict:
+            self.register_buffer('features_{}'.format(self.num_layers),
+                                 torch.zeros_like(state_dict[prefix + 'features_{}'.format(self.num_layers)]))
+            self.num_layers += 1
+        super(FeatureMemory, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def reset(self):
+        """Drop all the stored features."""
+        self.timestamps.fill_(-1)
+        self.num_written.zero_()
+
+    def extra_repr(self) -> str:
+        return 'size={}, max_staleness={}'.format(self.size, self.max_staleness)
@@ -1,6 +1,5 @@
 import torch.nn as nn
 import functools
-import random
 import torch
 from torch.nn import init
 
@@ -71,6 +70,9 @@ class ImagePool:
     This buffer enables us to update discriminators using a history of generated images
     rather than the ones produced by the latest generators.
 
+    The images are stored in a single tensor of shape :math:`(pool\_size, C, H, W)`, allocated on the first query
+    on the device of the images, and each query is processed for the whole mini-batch at once.
+
     Args:
         pool_size (int): the size of image buffer, if pool_size=0, no buffer will be created
 
@@ -80,8 +82,9 @@ class ImagePool:
         self.pool_size = pool_size
         if self.pool_size > 0:  # create an empty pool
             self.num_imgs = 0
-            self.images = []
+            self.images = None
 
+    @torch.no_grad()
     def query(self, images):
         """Return an image from the pool.
 
@@ -93,26 +96,32 @@ class ImagePool:
             By 50/100, the buffer will return images previously stored in the buffer,
             and insert the current images to the buffer.
 
+        .. note::
+            The images of a mini-batch which are swapped replace distinct images of the buffer, so an image inserted
+            by a query is never returned by the same query. When more images than `pool_size` are swapped at once,
+            the extra ones are returned as they are.
+
         """
         if self.pool_size == 0:  # if the buffer size is 0, do nothing
             return images
-        return_images = []
-        for image in images:
-            image = torch.unsqueeze(image.data, 0)
-            if self.num_imgs < self.pool_size:   # if the buffer is not full; keep inserting current images to the buffer
-                self.num_imgs = self.num_imgs + 1
-                self.images.append(image)
-                return_images.append(image)
-            else:
-                p = random.uniform(0, 1)
-                if p > 0.5:  # by 50% chance, the buffer will return a previously stored image, and insert the current image into the buffer
-                    random_id = random.randint(0, self.pool_size - 1)  # randint is inclusive
-                    tmp = self.images[random_id].clone()
-                    self.images[random_id] = image
-                    return_images.append(tmp)
-                else:       # by another 50% chance, the buffer will return the current image
-                    return_images.append(image)
-        return_images = torch.cat(return_images, 0)   # collect all the images and return
+        images = images.detach()
+        if self.images is None:
+            self.images = images.new_empty((self.pool_size,) + images.shape[1:])
+        return_images = images.clone()
+
+        # if the buffer is not full; keep inserting current images to the buffer
+        num_inserted = min(images.size(0), self.pool_size - self.num_imgs)
+        self.images[self.num_imgs:self.num_imgs + num_inserted] = images[:num_inserted]
+        self.num_imgs += num_inserted
+
+        # by 50% chance, the buffer will return a previously stored image, and insert the current image into the buffer
+        swap = num_inserted + torch.nonzero(
+            torch.rand(images.size(0) - num_inserted, device=images.device) > 0.5, as_tuple=False).view(-1)
+        swap = swap[:self.pool_size]
+        if swap.numel() > 0:
+            random_ids = torch.randperm(self.pool_size, device=images.device)[:swap.numel()]
+            return_images.index_copy_(0, swap, self.images.index_select(0, random_ids))
+            self.images.index_copy_(0, random_ids, images.index_select(0, swap))
         return return_images
 
 
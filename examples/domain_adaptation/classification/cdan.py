@@ -203,14 +203,12 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
 
         cls_loss = F.cross_entropy(y_s, labels_s)
         transfer_loss = domain_adv(y_s, f_s, y_t, f_t)
-        domain_acc = domain_adv.domain_discriminator_accuracy
         loss = cls_loss + transfer_loss * args.trade_off
 
         cls_acc = accuracy(y_s, labels_s)[0]
 
         losses.update(loss.item(), x_s.size(0))
         cls_accs.update(cls_acc, x_s.size(0))
-        domain_accs.update(domain_acc, x_s.size(0))
         trans_losses.update(transfer_loss.item(), x_s.size(0))
 
         # compute gradient and do SGD step
@@ -224,6 +222,7 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         end = time.time()
 
         if i % args.print_freq == 0:
+            domain_accs.update(domain_adv.domain_discriminator_accuracy, x_s.size(0))
             progress.display(i)
 
 
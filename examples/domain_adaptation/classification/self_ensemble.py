@@ -141,7 +141,7 @@ def main(args: argparse.Namespace):
 
     checkpoint = torch.load(args.pretrain, map_location='cpu')
     classifier.load_state_dict(checkpoint)
-    teacher = EmaTeacher(classifier, alpha=args.alpha)
+    teacher = EmaTeacher(classifier, alpha=args.alpha, buffers=args.ema_buffers, update_every=args.ema_update_every)
     consistent_loss = L2ConsistencyLoss().to(device)
     class_balance_loss = ClassBalanceLoss(num_classes).to(device)
 
@@ -391,6 +391,11 @@ if __name__ == '__main__':
     parser.add_argument('--lr-gamma', default=0.001, type=float, help='parameter for lr scheduler')
     parser.add_argument('--lr-decay', default=0.75, type=float, help='parameter for lr scheduler')
     parser.add_argument('--alpha', default=0.99, type=float, help='ema decay rate (default: 0.99)')
+    parser.add_argument('--ema-buffers', default=None, choices=['copy', 'ema'],
+                        help='how the teacher buffers (e.g. BatchNorm statistics) follow the student. '
+                             'Not updated by default')
+    parser.add_argument('--ema-update-every', default=1, type=int,
+                        help='update the teacher every N iterations (default: 1)')
     parser.add_argument('--threshold', default=0.8, type=float, help='confidence threshold')
     parser.add_argument('--trade-off-cons', default=3, type=float, help='trade off parameter for consistent loss')
     parser.add_argument('--trade-off-balance', default=0.01, type=float,
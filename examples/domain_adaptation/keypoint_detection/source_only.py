@@ -19,8 +19,8 @@ import common.vision.datasets.keypoint_detection as datasets
 import common.vision.transforms.keypoint_detection as T
 from common.vision.transforms import Denormalize
 from common.utils.data import ForeverDataIterator
-from common.utils.meter import AverageMeter, ProgressMeter, AverageMeterDict
-from common.utils.metric.keypoint_detection import accuracy
+from common.utils.meter import AverageMeter, ProgressMeter
+from common.utils.metric.keypoint_detection import accuracy, PCK
 from common.utils.logger import CompleteLogger
 
 
@@ -218,10 +218,10 @@ def train(train_source_iter, train_target_iter, model, criterion,
 def validate(val_loader, model, criterion, visualize, args: argparse.Namespace):
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.2e')
-    acc = AverageMeterDict(val_loader.dataset.keypoints_group.keys(), ":3.2f")
+    pck = PCK()
     progress = ProgressMeter(
         len(val_loader),
-        [batch_time, losses, acc['all']],
+        [batch_time, losses],
         prefix='Test: ')
 
     # switch to evaluate mode
@@ -239,12 +239,8 @@ def validate(val_loader, model, criterion, visualize, args: argparse.Namespace):
             loss = criterion(y, label, weight)
 
             # measure accuracy and record loss
-            losses.update(loss.item(), x.size(0))
-            acc_per_points, avg_acc, cnt, pred = accuracy(y.cpu().numpy(),
-                                                          label.cpu().numpy())
-
-            group_acc = val_loader.dataset.group_accuracy(acc_per_points)
-            acc.update(group_acc, x.size(0))
+            losses.update(loss, x.size(0))
+            pred = pck.update(y, label)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -252,11 +248,14 @@ def validate(val_loader, model, criterion, visualize, args: argparse.Namespace):
 
             if i % args.print_freq == 0:
                 progress.display(i)
+                acc_per_points, _ = pck.compute()
+                print('Test: [{}]\tAcc@all {:3.2f}'.format(i, val_loader.dataset.group_accuracy(acc_per_points)['all']))
                 if visualize is not None:
-                    visualize(x[0], pred[0] * args.image_size / args.heatmap_size, "val_{}_pred.jpg".format(i))
+                    visualize(x[0], pred[0].cpu() * args.image_size / args.heatmap_size, "val_{}_pred.jpg".format(i))
                     visualize(x[0], meta['keypoint2d'][0], "val_{}_label.jpg".format(i))
 
-    return acc.average()
+    acc_per_points, _ = pck.compute()
+    return val_loader.dataset.group_accuracy(acc_per_points)
 
 
 if __name__ == '__main__':
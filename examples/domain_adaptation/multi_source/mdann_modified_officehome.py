@@ -293,7 +293,6 @@ def train(train_source_iter: ForeverDataIterator,
 
         #transfer_loss = multidomain_adv(f, d_labels)
         transfer_loss = multidomain_adv(f_s, f_t, domain_labels_s, domain_labels_t)
-        domain_acc = multidomain_adv.domain_discriminator_accuracy
         # this loss functions works because of the gradient reversal layer
         loss = cls_loss + transfer_loss * args.trade_off
 
@@ -301,7 +300,6 @@ def train(train_source_iter: ForeverDataIterator,
 
         losses.update(loss.item(), x_s.size(0))
         cls_accs.update(cls_acc.item(), x_s.size(0))
-        domain_accs.update(domain_acc.item(), x_s.size(0))
         # seperated loss between two heads
         cls_losses.update(cls_loss.item(), x_s.size(0))
         transfer_losses.update(transfer_loss.item(), x_s.size(0))
@@ -317,6 +315,7 @@ def train(train_source_iter: ForeverDataIterator,
         end = time.time()
 
         if i % args.print_freq == 0:
+            domain_accs.update(multidomain_adv.domain_discriminator_accuracy.item(), x_s.size(0))
             progress.display(i)
 
     # tensorboard updates
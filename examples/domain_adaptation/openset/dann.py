@@ -195,7 +195,6 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
 
         cls_loss = F.cross_entropy(y_s, labels_s)
         transfer_loss = domain_adv(f_s, f_t)
-        domain_acc = domain_adv.domain_discriminator_accuracy
         loss = cls_loss + transfer_loss * args.trade_off
 
         cls_acc = accuracy(y_s, labels_s)[0]
@@ -204,7 +203,6 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         losses.update(loss.item(), x_s.size(0))
         cls_accs.update(cls_acc.item(), x_s.size(0))
         tgt_accs.update(tgt_acc.item(), x_s.size(0))
-        domain_accs.update(domain_acc.item(), x_s.size(0))
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
@@ -217,6 +215,7 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         end = time.time()
 
         if i % args.print_freq == 0:
+            domain_accs.update(domain_adv.domain_discriminator_accuracy.item(), x_s.size(0))
             progress.display(i)
 
 
@@ -242,8 +242,6 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         losses.update(loss.item(), x_s.size(0))
         cls_accs.update(cls_acc.item(), x_s.size(0))
         tgt_accs.update(tgt_acc.item(), x_s.size(0))
-        domain_accs_D.update(domain_adv_D.domain_discriminator_accuracy, x_s.size(0))
-        domain_accs_D_0.update(domain_adv_D_0.domain_discriminator_accuracy, x_s.size(0))
 
         # debug: output class weight averaged on the partial classes and non-partial classes respectively
         partial_class_weight, non_partial_classes_weight = \
@@ -255,6 +253,8 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         end = time.time()
 
         if i % args.print_freq == 0:
+            domain_accs_D.update(domain_adv_D.domain_discriminator_accuracy, x_s.size(0))
+            domain_accs_D_0.update(domain_adv_D_0.domain_discriminator_accuracy, x_s.size(0))
             progress.display(i)
 
 
@@ -105,7 +105,9 @@ def main(args: argparse.Namespace):
     domain_discri = DomainDiscriminator(in_feature=classifier.features_dim, hidden_size=1024).to(device)
     class_weight_module = AutomaticUpdateClassWeightModule(args.class_weight_update_steps, train_target_loader,
                                                            classifier, num_classes, device, args.temperature,
-                                                           train_target_dataset.partial_classes_idx)
+                                                           train_target_dataset.partial_classes_idx,
+                                                           momentum=args.class_weight_momentum,
+                                                           background=args.class_weight_background)
     # define optimizer and lr scheduler
     optimizer = SGD(classifier.get_parameters() + domain_discri.get_parameters(),
                     args.lr, momentum=args.momentum, weight_decay=args.weight_decay, nesterov=True)
@@ -208,9 +210,8 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         cls_loss = F.cross_entropy(y_s, labels_s, class_weight_module.get_class_weight_for_cross_entropy_loss())
         w_s, w_t = class_weight_module.get_class_weight_for_adversarial_loss(labels_s)
         transfer_loss = domain_adv(f_s, f_t, w_s, w_t)
-        class_weight_module.step()
+        class_weight_module.step(y_t)
         partial_classes_weight, non_partial_classes_weight = class_weight_module.get_partial_classes_weight()
-        domain_acc = domain_adv.domain_discriminator_accuracy
         loss = cls_loss + transfer_loss * args.trade_off
 
         cls_acc = accuracy(y_s, labels_s)[0]
@@ -218,7 +219,6 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
 
         losses.update(loss.item(), x_s.size(0))
         cls_accs.update(cls_acc.item(), x_s.size(0))
-        domain_accs.update(domain_acc.item(), x_s.size(0))
         tgt_accs.update(tgt_acc.item(), x_s.size(0))
         partial_classes_weights.update(partial_classes_weight.item(), x_s.size(0))
         non_partial_classes_weights.update(non_partial_classes_weight.item(), x_s.size(0))
@@ -234,7 +234,11 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         end = time.time()
 
         if i % args.print_freq == 0:
+            domain_accs.update(domain_adv.domain_discriminator_accuracy.item(), x_s.size(0))
             progress.display(i)
+            if args.class_weight_momentum is not None or args.class_weight_background:
+                print("Class weight staleness: {} iterations, incremental error: {}".format(
+                    class_weight_module.staleness, class_weight_module.incremental_error))
 
 
 def validate(val_loader: DataLoader, model: ImageClassifier, args: argparse.Namespace):
@@ -322,6 +326,12 @@ if __name__ == '__main__':
                         help='Number of steps to update class weight once')
     parser.add_argument('--temperature', default=0.1, type=float,
                         help='temperature for softmax when calculating class weight')
+    parser.add_argument('--class-weight-momentum', default=None, type=float,
+                        help='if given, estimate the class weight incrementally from the target mini-batches '
+                             'with this momentum instead of a full pass every class-weight-update-steps')
+    parser.add_argument('--class-weight-background', action='store_true',
+                        help='run the full pass to estimate the class weight in the background '
+                             'on a copy of the classifier')
     parser.add_argument('--trade-off', default=1., type=float,
                         help='the trade-off hyper-parameter for transfer loss')
     # training parameters
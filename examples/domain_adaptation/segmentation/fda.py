@@ -19,11 +19,12 @@ sys.path.append('../../..')
 from dalib.translation.fourier_transform import FourierTransform
 from dalib.adaptation.segmentation.fda import robust_entropy
 import common.vision.models.segmentation as models
+from common.vision.models.segmentation.deeplabv2 import tiled_inference
 import common.vision.datasets.segmentation as datasets
 import common.vision.transforms.segmentation as T
 from common.vision.transforms import DeNormalizeAndTranspose
 from common.utils.data import ForeverDataIterator
-from common.utils.metric import ConfusionMatrix
+from common.utils.metric import SegmentationEvaluator
 from common.utils.meter import AverageMeter, ProgressMeter, Meter
 from common.utils.logger import CompleteLogger
 
@@ -188,8 +189,8 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
     iou_s = Meter('IoU (s)', ':3.2f')
     iou_t = Meter('IoU (t)', ':3.2f')
 
-    confmat_s = ConfusionMatrix(model.num_classes)
-    confmat_t = ConfusionMatrix(model.num_classes)
+    confmat_s = SegmentationEvaluator(model.num_classes)
+    confmat_t = SegmentationEvaluator(model.num_classes)
     progress = ProgressMeter(
         args.iters_per_epoch,
         [batch_time, data_time, losses_s, losses_t, losses_entropy_t,
@@ -235,20 +236,20 @@ def train(train_source_iter: ForeverDataIterator, train_target_iter: ForeverData
         losses_t.update(loss_cls_t.item(), x_s.size(0))
         losses_entropy_t.update(loss_entropy_t.item(), x_s.size(0))
 
-        confmat_s.update(label_s.flatten(), pred_s.argmax(1).flatten())
-        confmat_t.update(label_t.flatten(), pred_t.argmax(1).flatten())
-        acc_global_s, acc_s, iu_s = confmat_s.compute()
-        acc_global_t, acc_t, iu_t = confmat_t.compute()
-        accuracies_s.update(acc_s.mean().item())
-        accuracies_t.update(acc_t.mean().item())
-        iou_s.update(iu_s.mean().item())
-        iou_t.update(iu_t.mean().item())
+        confmat_s.update(label_s, pred_s)
+        confmat_t.update(label_t, pred_t)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
         if i % args.print_freq == 0:
+            acc_global_s, acc_s, iu_s = confmat_s.compute()
+            acc_global_t, acc_t, iu_t = confmat_t.compute()
+            accuracies_s.update(acc_s.mean().item())
+            accuracies_t.update(acc_t.mean().item())
+            iou_s.update(iu_s.mean().item())
+            iou_t.update(iu_t.mean().item())
             progress.display(i)
 
             if visualize is not None:
@@ -268,7 +269,7 @@ def validate(val_loader: DataLoader, model, interp, criterion, visualize, args:
 
     # switch to evaluate mode
     model.eval()
-    confmat = ConfusionMatrix(model.num_classes)
+    confmat = SegmentationEvaluator(model.num_classes)
 
     with torch.no_grad():
         end = time.time()
@@ -277,21 +278,26 @@ def validate(val_loader: DataLoader, model, interp, criterion, visualize, args:
             label = label.long().to(device)
 
             # compute output
-            output = interp(model(x))
+            if args.test_tile_size is None and not args.test_flip:
+                output = interp(model(x))
+            else:
+                output = tiled_inference(model, x, args.test_output_size[::-1],
+                                         args.test_tile_size[::-1] if args.test_tile_size is not None else None,
+                                         args.test_tile_overlap, args.test_tile_batch_size, args.test_flip)
             loss = criterion(output, label)
 
             # measure accuracy and record loss
-            losses.update(loss.item(), x.size(0))
-            confmat.update(label.flatten(), output.argmax(1).flatten())
-            acc_global, accs, iu = confmat.compute()
-            acc.update(accs.mean().item())
-            iou.update(iu.mean().item())
+            losses.update(loss, x.size(0))
+            confmat.update(label, output)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
             if i % args.print_freq == 0:
+                acc_global, accs, iu = confmat.compute()
+                acc.update(accs.mean().item())
+                iou.update(iu.mean().item())
                 progress.display(i)
 
                 if visualize is not None:
@@ -325,6 +331,15 @@ if __name__ == '__main__':
                         help='the input image size during test')
     parser.add_argument('--test-output-size', nargs='+', type=int, default=(2048, 1024),
                         help='the output image size during test')
+    parser.add_argument('--test-tile-size', nargs='+', type=int, default=None,
+                        help='the input tile size of sliding-window inference during test. '
+                             'If not set, whole images are forwarded')
+    parser.add_argument('--test-tile-overlap', type=float, default=1. / 3,
+                        help='the fraction of the tile size by which neighbouring tiles overlap during test')
+    parser.add_argument('--test-tile-batch-size', type=int, default=1,
+                        help='the number of tiles forwarded at a time during test')
+    parser.add_argument('--test-flip', action='store_true',
+                        help='average the predictions on horizontally flipped images during test')
     # model parameters
     parser.add_argument('-a', '--arch', metavar='ARCH', default='deeplabv2_resnet101',
                         choices=architecture_names,
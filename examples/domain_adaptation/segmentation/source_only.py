@@ -16,11 +16,12 @@ from torch.utils.data import DataLoader
 
 sys.path.append('../../..')
 import common.vision.models.segmentation as models
+from common.vision.models.segmentation.deeplabv2 import tiled_inference
 import common.vision.datasets.segmentation as datasets
 import common.vision.transforms.segmentation as T
 from common.vision.transforms import DeNormalizeAndTranspose
 from common.utils.data import ForeverDataIterator
-from common.utils.metric import ConfusionMatrix
+from common.utils.metric import SegmentationEvaluator
 from common.utils.meter import AverageMeter, ProgressMeter, Meter
 from common.utils.logger import CompleteLogger
 
@@ -162,7 +163,7 @@ def train(train_source_iter: ForeverDataIterator, model, interp, criterion, opti
     accuracies_s = Meter('Acc (s)', ':3.2f')
     iou_s = Meter('IoU (s)', ':3.2f')
 
-    confmat_s = ConfusionMatrix(model.num_classes)
+    confmat_s = SegmentationEvaluator(model.num_classes)
     progress = ProgressMeter(
         args.iters_per_epoch,
         [batch_time, data_time, losses_s,
@@ -194,16 +195,16 @@ def train(train_source_iter: ForeverDataIterator, model, interp, criterion, opti
 
         # measure accuracy and record loss
         losses_s.update(loss_cls_s.item(), x_s.size(0))
-        confmat_s.update(label_s.flatten(), pred_s.argmax(1).flatten())
-        acc_global_s, acc_s, iu_s = confmat_s.compute()
-        accuracies_s.update(acc_s.mean().item())
-        iou_s.update(iu_s.mean().item())
+        confmat_s.update(label_s, pred_s)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
         if i % args.print_freq == 0:
+            acc_global_s, acc_s, iu_s = confmat_s.compute()
+            accuracies_s.update(acc_s.mean().item())
+            iou_s.update(iu_s.mean().item())
             progress.display(i)
 
             if visualize is not None:
@@ -222,7 +223,7 @@ def validate(val_loader: DataLoader, model, interp, criterion, visualize, args:
 
     # switch to evaluate mode
     model.eval()
-    confmat = ConfusionMatrix(model.num_classes)
+    confmat = SegmentationEvaluator(model.num_classes)
 
     with torch.no_grad():
         end = time.time()
@@ -231,21 +232,26 @@ def validate(val_loader: DataLoader, model, interp, criterion, visualize, args:
             label = label.long().to(device)
 
             # compute output
-            output = interp(model(x))
+            if args.test_tile_size is None and not args.test_flip:
+                output = interp(model(x))
+            else:
+                output = tiled_inference(model, x, args.test_output_size[::-1],
+                                         args.test_tile_size[::-1] if args.test_tile_size is not None else None,
+                                         args.test_tile_overlap, args.test_tile_batch_size, args.test_flip)
             loss = criterion(output, label)
 
             # measure accuracy and record loss
-            losses.update(loss.item(), x.size(0))
-            confmat.update(label.flatten(), output.argmax(1).flatten())
-            acc_global, accs, iu = confmat.compute()
-            acc.update(accs.mean().item())
-            iou.update(iu.mean().item())
+            losses.update(loss, x.size(0))
+            confmat.update(label, output)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
             end = time.time()
 
             if i % args.print_freq == 0:
+                acc_global, accs, iu = confmat.compute()
+                acc.update(accs.mean().item())
+                iou.update(iu.mean().item())
                 progress.display(i)
 
                 if visualize is not None:
@@ -281,6 +287,15 @@ if __name__ == '__main__':
                         help='the input image size during test')
     parser.add_argument('--test-output-size', nargs='+', type=int, default=(2048, 1024),
                         help='the output image size during test')
+    parser.add_argument('--test-tile-size', nargs='+', type=int, default=None,
+                        help='the input tile size of sliding-window inference during test. '
+                             'If not set, whole images are forwarded')
+    parser.add_argument('--test-tile-overlap', type=float, default=1. / 3,
+                        help='the fraction of the tile size by which neighbouring tiles overlap during test')
+    parser.add_argument('--test-tile-batch-size', type=int, default=1,
+                        help='the number of tiles forwarded at a time during test')
+    parser.add_argument('--test-flip', action='store_true',
+                        help='average the predictions on horizontally flipped images during test')
     # model parameters
     parser.add_argument('-a', '--arch', metavar='ARCH', default='deeplabv2_resnet101',
                         choices=architecture_names,
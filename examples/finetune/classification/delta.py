@@ -9,8 +9,6 @@ import shutil
 
 import torch
 import torch.nn as nn
-import numpy as np
-from tqdm import tqdm
 import torch.backends.cudnn as cudnn
 from torch.optim import SGD
 from torch.utils.data import DataLoader
@@ -23,7 +21,7 @@ from common.modules.classifier import Classifier
 import common.vision.datasets as datasets
 import common.vision.models as models
 from common.vision.transforms import ResizeImage
-from common.utils.data import ForeverDataIterator
+from common.utils.data import ForeverDataIterator, DeterministicAugmentationDataset
 from common.utils.metric import accuracy
 from common.utils.meter import AverageMeter, ProgressMeter
 from common.utils.logger import CompleteLogger
@@ -65,8 +63,13 @@ def main(args: argparse.Namespace):
 
     dataset = datasets.__dict__[args.data]
     train_dataset = dataset(root=args.root, split='train', sample_rate=args.sample_rate, download=True, transform=train_transform)
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size,
-                                     shuffle=True, num_workers=args.workers, drop_last=True)
+    if args.source_cache_size > 0:
+        # draw the augmentations from a fixed set, so that the source feature maps can be cached
+        train_loader = DataLoader(DeterministicAugmentationDataset(train_dataset, args.num_augmentations),
+                                  batch_size=args.batch_size, shuffle=True, num_workers=args.workers, drop_last=True)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=args.batch_size,
+                                         shuffle=True, num_workers=args.workers, drop_last=True)
     val_dataset = dataset(root=args.root, split='test', sample_rate=100, download=True, transform=val_transform)
     val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.workers)
     train_iter = ForeverDataIterator(train_loader)
@@ -101,8 +104,10 @@ def main(args: argparse.Namespace):
         return_layers = ['backbone.layer1.2.conv3', 'backbone.layer2.3.conv3', 'backbone.layer3.5.conv3', 'backbone.layer4.2.conv3']
     else:
         raise NotImplementedError(args.arch)
-    source_getter = IntermediateLayerGetter(source_classifier, return_layers=return_layers)
+    source_getter = IntermediateLayerGetter(source_classifier, return_layers=return_layers, keep_output=False)
     target_getter = IntermediateLayerGetter(classifier, return_layers=return_layers)
+    if args.source_cache_size > 0:
+        source_getter = ActivationCache(source_getter, max_size=args.source_cache_size, device=args.source_cache_device)
 
     # get regularization
     if args.regularization_type == 'l2_sp':
@@ -111,13 +116,20 @@ def main(args: argparse.Namespace):
         backbone_regularization = BehavioralRegularization()
     elif args.regularization_type == 'attention_feature_map':
         attention_file = os.path.join(logger.root, args.attention_file)
-        if not os.path.exists(attention_file):
-            attention = calculate_channel_attention(train_dataset, return_layers, args)
-            torch.save(attention, attention_file)
-        else:
-            print("Loading channel attention from", attention_file)
-            attention = torch.load(attention_file)
-            attention = [a.to(device) for a in attention]
+        attention_key = get_channel_attention_key(args)
+        attention = None
+        if os.path.exists(attention_file):
+            cached = torch.load(attention_file)
+            # files written before the key was stored only contain the attention
+            if not isinstance(cached, dict) or cached['key'] == attention_key:
+                print("Loading channel attention from", attention_file)
+                attention = cached['attention'] if isinstance(cached, dict) else cached
+                attention = [a.to(device) for a in attention]
+            else:
+                print("Channel attention in", attention_file, "was calculated with other settings")
+        if attention is None:
+            attention = train_and_calculate_channel_attention(train_dataset, return_layers, args)
+            torch.save({'key': attention_key, 'attention': attention}, attention_file)
         backbone_regularization = AttentionBehavioralRegularization(attention)
     else:
         raise NotImplementedError(args.regularization_type)
@@ -146,7 +158,7 @@ def main(args: argparse.Namespace):
     logger.close()
 
 
-def calculate_channel_attention(dataset, return_layers, args):
+def train_and_calculate_channel_attention(dataset, return_layers, args):
     backbone = models.__dict__[args.arch](pretrained=True)
     classifier = Classifier(backbone, dataset.num_classes).to(device)
     optimizer = SGD(classifier.get_parameters(args.lr), momentum=args.momentum, weight_decay=args.wd, nesterov=True)
@@ -155,12 +167,6 @@ def calculate_channel_attention(dataset, return_layers, args):
     lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=math.exp(math.log(0.1) / args.attention_lr_decay_epochs))
     criterion = nn.CrossEntropyLoss()
 
-    channel_weights = []
-    for layer_id, name in enumerate(return_layers):
-        layer = get_attribute(classifier, name)
-        layer_channel_weight = [0] * layer.out_channels
-        channel_weights.append(layer_channel_weight)
-
     # train the classifier
     classifier.train()
     classifier.backbone.requires_grad = False
@@ -194,51 +200,24 @@ def calculate_channel_attention(dataset, return_layers, args):
 
     # calculate the channel attention
     print('Calculating channel attention.')
-    classifier.eval()
-    if args.attention_iteration_limit > 0:
-        total_iteration = min(len(data_loader), args.attention_iteration_limit)
-    else:
-        total_iteration = len(args.data_loader)
+    return calculate_channel_attention(classifier, data_loader, return_layers,
+                                       iteration_limit=args.attention_iteration_limit,
+                                       channels_per_forward=args.attention_channels_per_forward,
+                                       devices=args.attention_devices)
 
-    progress = ProgressMeter(
-        total_iteration,
-        [],
-        prefix="Iteration: ")
-
-    for i, data in enumerate(data_loader):
-        if i >= total_iteration:
-            break
-        inputs, labels = data
-        inputs = inputs.to(device)
-        labels = labels.to(device)
-        outputs, _ = classifier(inputs)
-        loss_0 = criterion(outputs, labels)
-        progress.display(i)
-        for layer_id, name in enumerate(tqdm(return_layers)):
-            layer = get_attribute(classifier, name)
-            for j in range(layer.out_channels):
-                tmp = classifier.state_dict()[name + '.weight'][j,].clone()
-                classifier.state_dict()[name + '.weight'][j,] = 0.0
-                outputs, _ = classifier(inputs)
-                loss_1 = criterion(outputs, labels)
-                difference = loss_1 - loss_0
-                difference = difference.detach().cpu().numpy().item()
-                history_value = channel_weights[layer_id][j]
-                channel_weights[layer_id][j] = 1.0 * (i * history_value + difference) / (i + 1)
-                classifier.state_dict()[name + '.weight'][j, ] = tmp
-
-    channel_attention = []
-    for weight in channel_weights:
-        weight = np.array(weight)
-        weight = (weight - np.mean(weight)) / np.std(weight)
-        weight = torch.from_numpy(weight).float().to(device)
-        channel_attention.append(F.softmax(weight / 5).detach())
-    return channel_attention
+
+def get_channel_attention_key(args):
+    """The channel attention only depends on the pretrained checkpoint, the dataset and how the classifier is trained
+    before calculating it."""
+    return '_'.join(str(v) for v in [
+        args.arch, args.data, os.path.abspath(args.root), args.sample_rate, args.lr, args.momentum, args.wd,
+        args.seed, args.attention_batch_size, args.attention_epochs, args.attention_lr_decay_epochs,
+        args.attention_iteration_limit])
 
 
 def train(train_iter: ForeverDataIterator, model: Classifier, backbone_regularization:nn.Module,  head_regularization:nn.Module,
           target_getter: IntermediateLayerGetter,
-          source_getter: IntermediateLayerGetter,
+          source_getter,
           optimizer: SGD, epoch: int,  args: argparse.Namespace):
     batch_time = AverageMeter('Time', ':4.2f')
     data_time = AverageMeter('Data', ':3.1f')
@@ -257,7 +236,7 @@ def train(train_iter: ForeverDataIterator, model: Classifier, backbone_regulariz
 
     end = time.time()
     for i in range(args.iters_per_epoch):
-        x, labels = next(train_iter)
+        x, labels, *keys = next(train_iter)
         x = x.to(device)
         label = labels.to(device)
 
@@ -265,7 +244,14 @@ def train(train_iter: ForeverDataIterator, model: Classifier, backbone_regulariz
         data_time.update(time.time() - end)
 
         # compute output
-        intermediate_output_s, output_s = source_getter(x)
+        if args.regularization_type == 'l2_sp':
+            # the weight regularization does not need the source feature maps
+            intermediate_output_s = None
+        elif isinstance(source_getter, ActivationCache):
+            index, augmentation = keys
+            intermediate_output_s = source_getter(x, list(zip(index.tolist(), augmentation.tolist())))
+        else:
+            intermediate_output_s, _ = source_getter(x)
         intermediate_output_t, output_t = target_getter(x)
         y, f = output_t
 
@@ -374,6 +360,13 @@ if __name__ == '__main__':
                          help='trade-off for backbone regularization')
     parser.add_argument('--trade-off-head', default=0.01, type=float,
                         help='trade-off for head regularization')
+    parser.add_argument('--source-cache-size', default=0, type=int,
+                        help='number of (sample, augmentation) pairs whose source feature maps are cached. '
+                             '0 disables the cache (default: 0)')
+    parser.add_argument('--source-cache-device', default='cpu', type=str,
+                        help='device where the source feature maps are cached (default: cpu)')
+    parser.add_argument('--num-augmentations', default=4, type=int,
+                        help='number of fixed augmentations of each sample when the source cache is used (default: 4)')
 
     # training parameters
     parser.add_argument('-b', '--batch-size', default=48, type=int,
@@ -415,6 +408,11 @@ if __name__ == '__main__':
                         help='epochs to decay lr for training before calculating channel weight')
     parser.add_argument('--attention-iteration-limit', default=10, type=int, metavar='N',
                         help='iteration limits for calculating channel attention, -1 means no limits')
+    parser.add_argument('--attention-channels-per-forward', default=8, type=int, metavar='N',
+                        help='number of channels removed in a single forward pass when calculating channel attention')
+    parser.add_argument('--attention-devices', default=None, type=str, nargs='+',
+                        help='devices to spread the channel attention calculation over, e.g. cuda:0 cuda:1. '
+                             'None means the training device (default: None)')
 
     args = parser.parse_args()
     main(args)
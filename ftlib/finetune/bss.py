@@ -3,6 +3,9 @@ import torch.nn as nn
 
 __all__ = ['BatchSpectralShrinkage']
 
+# torch.linalg.eigvalsh is only available since torch 1.8
+_EIGVALSH = hasattr(torch, 'linalg') and hasattr(torch.linalg, 'eigvalsh')
+
 
 class BatchSpectralShrinkage(nn.Module):
     r"""
@@ -24,6 +27,11 @@ class BatchSpectralShrinkage(nn.Module):
 
     where the main diagonal elements of the singular value matrix :math:`\Sigma` is :math:`[\sigma_1, \sigma_2, ..., \sigma_b]`.
 
+    Since only the squared singular values are needed, they are computed as the eigenvalues of the Gram matrix of
+    the smaller side, :math:`FF^T` or :math:`F^TF`, which is much cheaper than a full `SVD` and does not compute
+    :math:`U` and :math:`V`. The computed values have an absolute error of about :math:`\epsilon \sigma_1^2`
+    (:math:`\epsilon` being the machine precision), which is negligible for the regularization term.
+
 
     Args:
         k (int):  The number of singular values to be penalized. Default: 1
@@ -38,9 +46,13 @@ class BatchSpectralShrinkage(nn.Module):
         self.k = k
 
     def forward(self, feature):
-        result = 0
-        u, s, v = torch.svd(feature.t())
-        num = s.size(0)
-        for i in range(self.k):
-            result += torch.pow(s[num-1-i], 2)
-        return result
+        if feature.size(0) <= feature.size(1):
+            gram = torch.mm(feature, feature.t())
+        else:
+            gram = torch.mm(feature.t(), feature)
+        # eigenvalues in ascending order, i.e. the squared singular values from the smallest one
+        if _EIGVALSH:
+            s2 = torch.linalg.eigvalsh(gram)
+        else:
+            s2, _ = torch.symeig(gram)
+        return s2[:self.k].clamp(min=0).sum()
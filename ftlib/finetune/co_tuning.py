@@ -1,5 +1,6 @@
 from typing import Tuple, Optional, List, Dict
 import os
+import hashlib
 import torch
 import torch.nn as nn
 import numpy as np
@@ -36,11 +37,17 @@ class CoTuningLoss(nn.Module):
 class Relationship(object):
     """Learns the category relationship p(y_s|y_t) between source dataset and target dataset.
 
+    The predictions of the source classifier are accumulated into per-class running sums on `device`, so the
+    predictions of the whole dataset are never stored.
+
     Args:
         data_loader (torch.utils.data.DataLoader): A data loader of target dataset.
-        classifier (torch.nn.Module): A classifier for Co-Tuning.
+        classifier (torch.nn.Module): A classifier for Co-Tuning, whose ``num_classes`` is the number of classes in
+          target dataset.
         device (torch.nn.Module): The device to run classifier.
-        cache (str, optional): Path to find and save the relationship file.
+        cache (str, optional): Path to find and save the relationship file. The file name is suffixed with a hash of
+          the source classifier weights, the samples of the dataset and its transform, so a cached relationship is
+          only reused when all of them are the same.
 
     """
     def __init__(self, data_loader, classifier, device, cache=None):
@@ -48,9 +55,11 @@ class Relationship(object):
         self.data_loader = data_loader
         self.classifier = classifier
         self.device = device
+        if cache is not None:
+            root, ext = os.path.splitext(cache)
+            cache = '{}_{}{}'.format(root, self.get_cache_key(), ext or '.npy')
         if cache is None or not os.path.exists(cache):
-            source_predictions, target_labels = self.collect_labels()
-            self.relationship = self.get_category_relationship(source_predictions, target_labels)
+            self.relationship = self.collect_relationship()
             if cache is not None:
                 np.save(cache, self.relationship)
         else:
@@ -59,6 +68,53 @@ class Relationship(object):
     def __getitem__(self, category):
         return self.relationship[category]
 
+    def get_cache_key(self):
+        """
+        Hash of everything the relationship depends on: the weights of the source classifier (the target head is not
+        used), and the samples and the transform of the dataset.
+        """
+        key = hashlib.sha1()
+        modules = [getattr(self.classifier, name) for name in ('backbone', 'head_source')
+                   if hasattr(self.classifier, name)] or [self.classifier]
+        for module in modules:
+            for name, tensor in module.state_dict().items():
+                key.update(name.encode())
+                key.update(tensor.detach().cpu().numpy().tobytes())
+        dataset = self.data_loader.dataset
+        samples = getattr(dataset, 'samples', None)
+        key.update(repr(samples if samples is not None else (type(dataset).__name__, len(dataset))).encode())
+        key.update(repr(getattr(dataset, 'transform', None)).encode())
+        return key.hexdigest()[:16]
+
+    def collect_relationship(self):
+        """
+        Collects the conditional probability p(y_s | y_t) by averaging the predictions of the source classifier
+        on each class of target dataset.
+
+        Returns:
+            Conditional probability, [N_c, N_p] matrix representing the conditional probability p(pre-trained class | target_class)
+        """
+        print("Collecting labels to calculate relationship")
+        sums, counts = None, None
+
+        self.classifier.eval()
+        with torch.no_grad():
+            for i, (x, label) in enumerate(tqdm.tqdm(self.data_loader)):
+                x = x.to(self.device)
+                label = label.to(self.device)
+                y_s, _ = self.classifier(x)
+                p_s = F.softmax(y_s, dim=1).double()
+
+                if sums is None:
+                    # sized once from the number of target classes of the classifier, so that the labels never
+                    # have to be read back from the device
+                    sums = p_s.new_zeros((self.classifier.num_classes, p_s.size(1)))
+                    counts = p_s.new_zeros((self.classifier.num_classes,))
+                sums.index_add_(0, label, p_s)
+                counts.index_add_(0, label, torch.ones_like(label, dtype=counts.dtype))
+
+        return (sums / counts.unsqueeze(1)).float().cpu().numpy()
+
     def collect_labels(self):
         """
         Collects predictions of target dataset by source model and corresponding ground truth class labels.
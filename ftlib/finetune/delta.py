@@ -1,8 +1,25 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
+import copy
 import functools
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# multi-tensor (foreach) ops support autograd since PyTorch 2.1
+_FOREACH_AUTOGRAD = hasattr(torch, '_foreach_norm') and \
+    tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 1)
+
+
+def _sum_of_squared_norms(tensors):
+    r"""
+    Return :math:`\sum_i \Vert t_i \Vert_2^2` over `tensors`, computing all the norms with a single multi-tensor kernel
+    when available instead of one kernel per tensor.
+    """
+    if _FOREACH_AUTOGRAD:
+        return torch.stack(torch._foreach_norm(tensors)).pow(2).sum()
+    return sum(torch.norm(t) ** 2 for t in tensors)
 
 
 class L2Regularization(nn.Module):
@@ -22,10 +39,7 @@ class L2Regularization(nn.Module):
         self.model = model
 
     def forward(self):
-        output = 0.0
-        for param in self.model.parameters():
-            output += 0.5 * torch.norm(param) ** 2
-        return output
+        return 0.5 * _sum_of_squared_norms(list(self.model.parameters()))
 
 
 class SPRegularization(nn.Module):
@@ -45,21 +59,33 @@ class SPRegularization(nn.Module):
         source_model (torch.nn.Module):  The source (starting point) model.
         target_model (torch.nn.Module):  The target (fine-tuning) model.
 
+    .. note::
+        The source weights are copied into a single contiguous tensor when the regularization is created, and
+        `source_weight` holds views of it, so later changes to `source_model` do not affect the regularization.
+
     Shape:
         - Output: scalar.
     """
     def __init__(self, source_model: nn.Module, target_model: nn.Module):
         super(SPRegularization, self).__init__()
         self.target_model = target_model
+        source_params = OrderedDict((name, param.detach()) for name, param in source_model.named_parameters())
+        self.source_weight_flat = torch.cat([param.reshape(-1) for param in source_params.values()]) \
+            if len(source_params) > 0 else torch.zeros(0)
         self.source_weight = {}
-        for name, param in source_model.named_parameters():
-            self.source_weight[name] = param.detach()
+        offset = 0
+        for name, param in source_params.items():
+            self.source_weight[name] = self.source_weight_flat[offset:offset + param.numel()].view_as(param)
+            offset += param.numel()
 
     def forward(self):
-        output = 0.0
-        for name, param in self.target_model.named_parameters():
-            output += 0.5 * torch.norm(param - self.source_weight[name]) ** 2
-        return output
+        names, params = zip(*self.target_model.named_parameters())
+        source_weight = [self.source_weight[name] for name in names]
+        if _FOREACH_AUTOGRAD:
+            diffs = torch._foreach_sub(list(params), source_weight)
+        else:
+            diffs = [param - weight for param, weight in zip(params, source_weight)]
+        return 0.5 * _sum_of_squared_norms(diffs)
 
 
 class BehavioralRegularization(nn.Module):
@@ -150,6 +176,9 @@ class IntermediateLayerGetter:
     r"""
     Wraps a model to get intermediate output values of selected layers.
 
+    The forward hooks are registered once when the getter is created, and only record the outputs during a call of
+    the getter, so calling the model directly is not affected. Call :meth:`remove` to remove the hooks.
+
     Args:
        model (torch.nn.Module): The model to collect intermediate layer feature maps.
        return_layers (list): The names of selected modules to return the output.
@@ -164,27 +193,192 @@ class IntermediateLayerGetter:
         self._model = model
         self.return_layers = return_layers
         self.keep_output = keep_output
-
-    def __call__(self, *args, **kwargs):
-        ret = OrderedDict()
-        handles = []
+        self._outputs = None
+        self._handles = []
         for name in self.return_layers:
             layer = get_attribute(self._model, name)
             def hook(module, input, output, name=name):
-                ret[name] = output
+                if self._outputs is not None:
+                    self._outputs[name] = output
             try:
                 h = layer.register_forward_hook(hook)
             except AttributeError as e:
                 raise AttributeError(f'Module {name} not found')
-            handles.append(h)
+            self._handles.append(h)
 
-        if self.keep_output:
+    def __call__(self, *args, **kwargs):
+        self._outputs = outputs = {}
+        try:
             output = self._model(*args, **kwargs)
-        else:
-            self._model(*args, **kwargs)
+        finally:
+            self._outputs = None
+        ret = OrderedDict((name, outputs[name]) for name in self.return_layers if name in outputs)
+
+        if not self.keep_output:
             output = None
+        return ret, output
 
-        for h in handles:
+    def remove(self):
+        """Remove the forward hooks from the model."""
+        for h in self._handles:
             h.remove()
+        self._handles = []
 
-        return ret, output
+
+class ActivationCache:
+    r"""
+    Caches the intermediate outputs of a frozen model (e.g. the source model of DELTA) for each sample, so that the
+    frozen model is only run on the samples which are not cached yet.
+
+    Each sample is identified by a hashable key, e.g. (sample index, augmentation seed) when the augmentations are
+    drawn from a fixed set of seeds with :class:`~common.utils.data.DeterministicAugmentationDataset`.
+    Samples with the same key must have the same input. When the cache is full, the least recently used samples
+    are dropped.
+
+    Args:
+        getter (IntermediateLayerGetter): The getter of the frozen model.
+        max_size (int, optional): The maximum number of cached samples. If None, the cache is not bounded.
+          Default: None
+        device (torch.device, optional): The device where the outputs are cached. If None, keep the device of the
+          outputs. Default: None
+
+    Inputs:
+        - x (tensor): The input of the frozen model.
+        - keys (list): The key of each sample in `x`.
+
+    Returns:
+        An OrderedDict of intermediate outputs, the same as the first output of `getter`.
+
+    .. note::
+        Each cached sample takes as much memory as its feature maps in all the selected layers.
+    """
+    def __init__(self, getter: IntermediateLayerGetter, max_size=None, device=None):
+        self.getter = getter
+        self.max_size = max_size
+        self.device = device
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, x, keys):
+        assert len(keys) == x.size(0)
+        entries = [self._cache.get(key) for key in keys]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if len(missing) > 0:
+            with torch.no_grad():
+                outputs, _ = self.getter(x[missing])
+            for j, i in enumerate(missing):
+                # copy each sample, so that a cached sample does not keep the whole mini-batch alive
+                entries[i] = [output[j].to(self.device or output.device, copy=True) for output in outputs.values()]
+                self._cache[keys[i]] = entries[i]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        for key in keys:
+            self._cache.move_to_end(key)
+        while self.max_size is not None and len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        return OrderedDict((name, torch.stack([entry[l] for entry in entries]).to(x.device))
+                           for l, name in enumerate(self.getter.return_layers))
+
+    def __len__(self):
+        return len(self._cache)
+
+    def clear(self):
+        """Drop all the cached samples."""
+        self._cache.clear()
+
+
+def _logits(outputs):
+    # classifiers of this library return (predictions, features)
+    return outputs[0] if isinstance(outputs, (tuple, list)) else outputs
+
+
+def _channel_ablation_losses(model, layer_name, inputs, labels, channels):
+    r"""
+    Return the mean cross entropy loss of `model` on (`inputs`, `labels`) when each channel in `channels` of the
+    layer `layer_name` is removed in turn. All the ablations run in a single forward pass over a batch expanded
+    :math:`len(channels)` times, where the output channels of the layer are masked by a hook.
+    """
+    layer = get_attribute(model, layer_name)
+    num_ablations, batch_size = len(channels), inputs.size(0)
+    mask = torch.ones(num_ablations, layer.out_channels, device=inputs.device)
+    mask[torch.arange(num_ablations), channels] = 0
+
+    def hook(module, input, output):
+        shape = (-1, output.size(1)) + (1,) * (output.dim() - 2)
+        channel_mask = mask.repeat_interleave(batch_size, dim=0).view(shape)
+        masked_output = output * channel_mask
+        if getattr(module, 'bias', None) is not None:
+            # zeroing the weights of a channel keeps its bias
+            masked_output = masked_output + (1 - channel_mask) * module.bias.view(shape[1:]).unsqueeze(0)
+        return masked_output
+
+    handle = layer.register_forward_hook(hook)
+    try:
+        outputs = _logits(model(inputs.repeat((num_ablations,) + (1,) * (inputs.dim() - 1))))
+    finally:
+        handle.remove()
+    return F.cross_entropy(outputs, labels.repeat(num_ablations), reduction='none').view(num_ablations, -1).mean(dim=1)
+
+
+@torch.no_grad()
+def calculate_channel_attention(model, data_loader, return_layers, iteration_limit=-1, channels_per_forward=8,
+                                devices=None, temperature=5.):
+    r"""
+    Calculate the channel attention of DELTA, i.e. the increase of the classification loss of `model` when each
+    channel of the selected layers is removed, normalized over the channels of each layer with a softmax.
+
+    Instead of one forward pass per channel, `channels_per_forward` channels are removed in a single forward pass over
+    an expanded batch. The ablations can also be spread over several `devices`, each running a copy of `model`.
+
+    Args:
+        model (torch.nn.Module): The classifier trained on the target dataset. It is put in eval mode.
+        data_loader (torch.utils.data.DataLoader): The loader of (input, label) of the target dataset.
+        return_layers (list): The names of the selected layers, which must have an `out_channels` attribute.
+        iteration_limit (int, optional): The maximum number of mini-batches. -1 means no limits. Default: -1
+        channels_per_forward (int, optional): Number of channels removed in a single forward pass. Default: 8
+        devices (list, optional): The devices to spread the ablations over. If None, use the device of `model`.
+          Default: None
+        temperature (float, optional): The temperature of the softmax. Default: 5.
+
+    Returns:
+        The channel attention of each layer in `return_layers`, a tensor of shape [C] for the layer with C channels.
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    devices = [device] if devices is None else [torch.device(d) for d in devices]
+    # each worker needs its own copy of the model, since the ablations are done with hooks
+    replicas = [model if i == 0 and d == device else copy.deepcopy(model).to(d).eval() for i, d in enumerate(devices)]
+    num_channels = [get_attribute(model, name).out_channels for name in return_layers]
+    channel_weights = [torch.zeros(c, dtype=torch.float64) for c in num_channels]
+    tasks = [(layer_id, torch.arange(start, min(start + channels_per_forward, c)))
+             for layer_id, c in enumerate(num_channels) for start in range(0, c, channels_per_forward)]
+
+    def run(replica_id, inputs, labels, loss_0):
+        replica, d = replicas[replica_id], devices[replica_id]
+        inputs, labels = inputs.to(d), labels.to(d)
+        results = []
+        for layer_id, channels in tasks[replica_id::len(replicas)]:
+            losses = _channel_ablation_losses(replica, return_layers[layer_id], inputs, labels, channels.to(d))
+            results.append((layer_id, channels, (losses - loss_0).double().cpu()))
+        return results
+
+    with ThreadPoolExecutor(max_workers=len(replicas)) as executor:
+        for i, (inputs, labels) in enumerate(data_loader):
+            if 0 < iteration_limit <= i:
+                break
+            inputs, labels = inputs.to(device), labels.to(device)
+            loss_0 = F.cross_entropy(_logits(model(inputs)), labels).item()
+            for results in executor.map(lambda replica_id: run(replica_id, inputs, labels, loss_0),
+                                        range(len(replicas))):
+                for layer_id, channels, difference in results:
+                    history_value = channel_weights[layer_id][channels]
+                    channel_weights[layer_id][channels] = (i * history_value + difference) / (i + 1)
+
+    channel_attention = []
+    for weight in channel_weights:
+        weight = (weight - weight.mean()) / weight.std(unbiased=False)
+        channel_attention.append(F.softmax(weight.float() / temperature, dim=0).to(device))
+    return channel_attention
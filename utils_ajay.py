@@ -3,9 +3,13 @@
 # June 21, 2021
 import sys
 import os
+import functools
 from typing import List, Tuple, Optional
+from concurrent.futures import ProcessPoolExecutor
 
 from scipy.optimize import minimize
+from scipy.fft import rfft, irfft, next_fast_len
+from scipy.sparse import csr_matrix
 from scipy.stats import norm
 from statsmodels.stats.proportion import proportion_confint
 from sklearn.metrics import confusion_matrix
@@ -37,20 +41,46 @@ def nll_fn(t, *args):
     return nll
 
 
+# Fit the temperature of temperature scaling (Guo et al., 2017) by
+# minimizing the NLL of logits / t with L-BFGS-B, using the analytic
+# gradient of the cross-entropy, which is computed with log_softmax
+# so large logits do not overflow.
+# If groups (N,) assigns each sample to one of num_groups splits or
+# domains, one temperature per group is fitted in the same optimization.
+# The objective is the sum of the mean NLL of each group, so every
+# temperature is the same as if its group was fitted alone.
+# Returns a tensor of num_groups temperatures (1 if groups is None).
+def fit_temperature(logits, labels, groups=None, num_groups=None, bounds=(0.05, 5.0), tol=1e-12):
+    logits = torch.as_tensor(logits).detach().to(torch.float64)
+    labels = torch.as_tensor(labels, dtype=torch.long, device=logits.device)
+    if groups is None:
+        groups = torch.zeros_like(labels)
+    groups = torch.as_tensor(groups, dtype=torch.long, device=logits.device)
+    if num_groups is None:
+        num_groups = int(groups.max()) + 1
+    group_size = torch.bincount(groups, minlength=num_groups).clamp(min=1)
+    sample_weight = 1. / group_size[groups].to(logits.dtype)
+
+    def nll_and_grad(t):
+        t = torch.tensor(t, dtype=logits.dtype, device=logits.device, requires_grad=True)
+        nll = F.cross_entropy(logits / t[groups, None], labels, reduction='none')
+        nll = torch.sum(nll * sample_weight)
+        grad, = torch.autograd.grad(nll, t)
+        return nll.item(), grad.cpu().numpy()
+
+    t = minimize(nll_and_grad, np.ones(num_groups), jac=True,
+                 method='L-BFGS-B', bounds=[bounds] * num_groups, tol=tol)
+    return torch.as_tensor(t.x, device=logits.device)
+
+
 # Use temperature scaling to modify probs, given labels.
 # If probs_test is given, return its calibrated version too.
 # Inspired by implementation of Zhang et al. (2020)
 # with additional clipping of input probs.
 def temp_scaling(logits, labels, n_classes, probs_test=[]):
 
-    y = np.eye(n_classes)[labels] # one-hot encoding
     eps = 1e-20
-    # ts_probs = np.clip(probs, eps, 1 - eps)
-    # ts_logits = np.log(ts_probs) - np.log(1 - ts_probs)
-    t = minimize(nll_fn, 1.0, args=(logits, y),
-                    method='L-BFGS-B', bounds=((0.05, 5.0),),
-                    tol=1e-12)
-    t = t.x
+    t = fit_temperature(logits, labels).cpu().numpy()
 
     # If provided, generate calibrated probs for the test set
     if probs_test != []:
@@ -77,6 +107,28 @@ def mirror_1d(d, xmin=None, xmax=None):
         return d
 
 
+# Evenly-spaced KDE evaluation points on [-0.6, 1.6) which include 0 and 1.
+# These values are based on the triweight kernel.
+# The grid is built once and must not be modified.
+@functools.lru_cache(maxsize=1)
+def kde_grid(step=0.0001):
+    x1 = np.arange(-0.6, 0.0, step)
+    x2 = np.arange(0.0, 1.0, step)
+    x3 = np.arange(1.0, 1.6, step)
+    return np.concatenate((x1, x2, x3))
+
+
+# Index of the closest point of the sorted grid x to each value,
+# the lower one on ties (same as np.abs(x - value).argmin()).
+# Only the two neighbours found by binary search are compared,
+# which takes O(N log G) instead of O(N G).
+def closest_grid_points(x, values):
+    values = np.asarray(values)
+    right = np.clip(np.searchsorted(x, values), 1, len(x) - 1)
+    left = right - 1
+    return np.where(np.abs(x[left] - values) <= np.abs(x[right] - values), left, right)
+
+
 # Compute the kernel ECE as described by Zhang et al. (2020)
 # https://github.com/zhang64-llnl/Mix-n-Match-Calibration
 # Kernel = triweight
@@ -93,15 +145,13 @@ def kernel_ece(probs, labels, classes, give_kde_points=False, order=1,
                binary=False, verbose=False):
 
     # X values for KDE evaluation points
-    # These values are based on the triweight kernel but may omit 0,1
-    #x = np.linspace(-0.6, 1.6, num=2**14)
-    # Instead, ensure that 0.0 and 1.0 are included
-    # Grid has to be evenly spaced
-    step = 0.0001
-    x1 = np.arange(-0.6, 0.0, step)
-    x2 = np.arange(0.0, 1.0, step)
-    x3 = np.arange(1.0, 1.6, step)
-    x = np.concatenate((x1, x2, x3))
+    x = kde_grid()
+    if isinstance(probs, torch.Tensor):
+        probs = probs.detach().cpu().numpy()
+    if isinstance(labels, torch.Tensor):
+        labels = labels.detach().cpu().numpy()
+    probs = np.asarray(probs)
+    labels = np.asarray(labels)
     N = len(labels)
 
     kernel = 'triweight'
@@ -114,11 +164,11 @@ def kernel_ece(probs, labels, classes, give_kde_points=False, order=1,
             sys.exit(1)
 
         # Store the indicator of presence of class 1
-        correct = [l == 1 for l in labels]
+        correct = labels == 1
         # Store the probability of class 1 instead of the argmax prob
         max_prob = probs[:, 1]
     else:
-        correct = [classes[p] == l for (p, l) in zip(max_pred, labels)]
+        correct = np.asarray(classes)[max_pred] == labels
         max_prob = np.max(probs, axis=1)
     probs_correct = max_prob[correct]
     if verbose:
@@ -170,18 +220,22 @@ def kernel_ece(probs, labels, classes, give_kde_points=False, order=1,
     # Sum the differences between confidence and accuracy
     # to get the (empirical) ECE for this data set,
     # using the closest grid point (x) to each prediction (pr)
-    closest = [np.abs(x - pr).argmin() for pr in max_prob]
-    est_acc = [perc * pp1[c] / pp2[c] for c in closest]
+    closest = closest_grid_points(x, max_prob)
+    est_acc = perc * pp1[closest] / pp2[closest]
     ece = np.sum(np.abs(max_prob - est_acc) ** order) / N
 
     if give_kde_points:
         # Return accuracy and estimated mass at each test point
-        z = [np.sum(pp2[c]) for c in closest]
+        z = pp2[closest]
         return ece, est_acc, max_prob, z
 
     return ece
 
 def squared_error(probs, labels, num_classes):
+    if isinstance(probs, torch.Tensor):
+        probs = probs.detach().cpu().numpy()
+    if isinstance(labels, torch.Tensor):
+        labels = labels.detach().cpu().numpy()
     probs = np.array(probs)
     labels = np.array(labels)
     shape = (labels.size, num_classes)
@@ -205,51 +259,160 @@ def bootstrap_conf_interval(data_getter, data_size, confidence=0.95, size=1000):
         bootstrap_distro[i] = data_getter(data_indices)
     return mean_confidence_interval(bootstrap_distro, confidence)
 
-def kernel_ece_conf_interval(probs, labels, classes, order=1, binary=False, confidence=0.95, size=1000):
-    
-    def data_getter(data_indices):
-        probs_star = []
-        labels_star = []
-        for i in data_indices:
-            probs_star.append(probs[i])
-            labels_star.append(labels[i])
-        return kernel_ece(probs_star, labels_star, classes, 
-                          False, order, binary)
-        
-    return bootstrap_conf_interval(data_getter, len(probs), confidence, size)
+# Draw `size` bootstrap resamples of `data_size` samples and evaluate `statistic`
+# on them. A chunk of resamples is drawn as one matrix of indices and passed to
+# `statistic` as counts of shape (chunk, data_size), i.e. how many times each
+# sample is drawn in each resample, so the statistic can reuse per-sample
+# quantities instead of building the resampled data.
+# Chunks run across a pool of `num_workers` processes (all cpus if None, none if 0).
+# Each chunk has its own seed spawned from `seed`, so the result only depends on
+# `seed` and `chunk_size`, not on the number of workers. If `seed` is None, it is
+# drawn from the global numpy random state.
+def bootstrap_distribution(statistic, data_size, size=1000, seed=None, num_workers=None, chunk_size=50):
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    chunk_sizes = [min(chunk_size, size - start) for start in range(0, size, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    args = ([statistic] * len(chunk_sizes), [data_size] * len(chunk_sizes), chunk_sizes, seeds)
+    if num_workers is None:
+        num_workers = min(os.cpu_count() or 1, len(chunk_sizes))
+    if num_workers > 1:
+        with ProcessPoolExecutor(num_workers) as executor:
+            results = list(executor.map(_bootstrap_chunk, *args))
+    else:
+        results = list(map(_bootstrap_chunk, *args))
+    return np.concatenate(results)
+
+def _bootstrap_chunk(statistic, data_size, num_resamples, seed):
+    indices = np.random.default_rng(seed).integers(data_size, size=(num_resamples, data_size))
+    offsets = np.arange(num_resamples)[:, None] * data_size
+    counts = np.bincount((indices + offsets).ravel(), minlength=num_resamples * data_size)
+    return statistic(counts.reshape(num_resamples, data_size).astype(float))
+
+
+# Mean of per-sample values, as a bootstrap statistic
+class MeanStatistic:
+    def __init__(self, values):
+        self.values = np.asarray(values, dtype=float)
+
+    def __call__(self, counts):
+        return counts @ self.values / len(self.values)
+
+
+# kernel_ece as a bootstrap statistic.
+# The KDEs of a resample are the same as FFTKDE on the resampled data:
+# linear binning on the grid weighted by the counts, convolved with the
+# triweight kernel (batched over the resamples with an FFT). The mirrored
+# data is binned and the grid points of the predictions are found only once.
+class KernelECEStatistic:
+    def __init__(self, probs, labels, classes, order=1, binary=False, kernel='triweight'):
+        if isinstance(probs, torch.Tensor):
+            probs = probs.detach().cpu().numpy()
+        if isinstance(labels, torch.Tensor):
+            labels = labels.detach().cpu().numpy()
+        probs = np.asarray(probs)
+        labels = np.asarray(labels)
+        if binary:
+            correct = labels == 1
+            max_prob = probs[:, 1]
+        else:
+            correct = np.asarray(classes)[np.argmax(probs, axis=1)] == labels
+            max_prob = np.max(probs, axis=1)
+        self.max_prob = max_prob.astype(float)
+        self.correct = correct.astype(float)
+        self.order = order
+        # The kernel object itself cannot be pickled for the worker processes
+        self.kernel_name = kernel
+        self.x = kde_grid()
+        self.dx = (self.x.max() - self.x.min()) / (len(self.x) - 1)
+        self.closest = closest_grid_points(self.x, self.max_prob)
+
+        # Each prediction and its reflection about the nearest domain boundary
+        # (as in mirror_1d) are linearly binned on the grid
+        reflection = np.where(self.max_prob < 0.5, -self.max_prob, 2 - self.max_prob)
+        fractional, integral = np.modf((np.stack([self.max_prob, reflection], 1) - self.x.min()) / self.dx)
+        integral = integral.astype(int)
+        rows = np.repeat(np.arange(len(self.max_prob)), 4)
+        columns = np.stack([integral, integral + 1], 2).ravel()
+        values = np.stack([1 - fractional, fractional], 2).ravel()
+        self.binning = csr_matrix((values, (rows, columns)), shape=(len(self.max_prob), len(self.x) + 1))
+
+    def __call__(self, counts):
+        N = counts.shape[1]
+        correct_counts = counts * self.correct
+        n_correct = correct_counts.sum(1)
+        mean = correct_counts @ self.max_prob / n_correct
+        std = np.sqrt(np.sum(correct_counts * (self.max_prob - mean[:, None]) ** 2, 1) / n_correct)
+        kbw = np.maximum(1.06 * std * (n_correct * 2) ** -0.2, 1e-4)
+
+        pp1 = self._kde(correct_counts, kbw)
+        pp2 = self._kde(counts, kbw)
+        perc = n_correct / N
+        est_acc = perc[:, None] * pp1[:, self.closest] / pp2[:, self.closest]
+        return np.sum(counts * np.abs(self.max_prob - est_acc) ** self.order, 1) / N
+
+    # KDE on the grid, zero outside of [0, 1] and doubled like in kernel_ece
+    def _kde(self, counts, kbw):
+        kernel = FFTKDE(kernel=self.kernel_name).kernel
+        histogram = (self.binning.T @ counts.T).T[:, :len(self.x)]
+        histogram /= 2 * counts.sum(1, keepdims=True)
+        # Half-width (in grid steps) of the support of the kernel of each resample
+        L = np.minimum(np.floor(kernel.support * kbw / self.dx), len(self.x)).astype(int)
+        max_L = L.max()
+        kernel_weights = np.zeros((len(kbw), 2 * max_L + 1))
+        for r, (l, bw) in enumerate(zip(L, kbw)):
+            kernel_grid = np.linspace(-self.dx * l, self.dx * l, 2 * l + 1)
+            kernel_weights[r, max_L - l:max_L + l + 1] = kernel(kernel_grid, bw=bw)
+        size = next_fast_len(len(self.x) + 2 * max_L)
+        pp = irfft(rfft(histogram, size) * rfft(kernel_weights, size), size)[:, max_L:max_L + len(self.x)]
+        pp += np.finfo(float).eps
+        pp[:, (self.x < 0.0) | (self.x > 1.0)] = 0
+        return pp * 2
+
+
+def kernel_ece_conf_interval(probs, labels, classes, order=1, binary=False, confidence=0.95, size=1000,
+                             seed=None, num_workers=None):
+    statistic = KernelECEStatistic(probs, labels, classes, order, binary)
+    bootstrap_distro = bootstrap_distribution(statistic, len(probs), size, seed, num_workers)
+    return mean_confidence_interval(bootstrap_distro, confidence)
 
-def brier_conf_interval(probs, labels, num_classes, confidence=0.95, size=1000):
-    squared_error_arr = squared_error(probs, labels, num_classes)
-    
-    def data_getter(data_indices):
-        return np.average(squared_error_arr[data_indices])
-    
-    return bootstrap_conf_interval(data_getter, len(probs), confidence, size)
+def brier_conf_interval(probs, labels, num_classes, confidence=0.95, size=1000, seed=None, num_workers=None):
+    statistic = MeanStatistic(squared_error(probs, labels, num_classes))
+    bootstrap_distro = bootstrap_distribution(statistic, len(probs), size, seed, num_workers)
+    return mean_confidence_interval(bootstrap_distro, confidence)
 
 
-def rejection_data(probs: List[List[int]], labels: List[int], classes: List[int], use_fraction_rejected: Optional[bool]=False,
+# Accuracy (and the half-width of its Agresti-Coull interval) of the predictions
+# kept when rejecting those below each max prob, sorted by max prob.
+# probs and labels may be lists, arrays or tensors.
+def rejection_data(probs, labels, classes: List[int], use_fraction_rejected: Optional[bool]=False,
                    confidence: Optional[float] = 0.95):
+    if isinstance(probs, torch.Tensor):
+        probs = probs.detach().cpu().numpy()
+    if isinstance(labels, torch.Tensor):
+        labels = labels.detach().cpu().numpy()
+    probs = np.asarray(probs, dtype=float)
+    labels = np.asarray(labels)
     assert len(probs) == len(labels)
-    data = [(max(probs[i]), float(max(classes, key=lambda j: probs[i][j]) == labels[i]), 0.) for i in range(len(labels))]
+    classes = np.asarray(classes)
+    max_prob = probs.max(axis=1)
+    # the first of the most likely classes, in the order of `classes`
+    acc = (classes[np.argmax(probs[:, classes], axis=1)] == labels).astype(float)
+    # sort by max prob, then by accuracy
+    order = np.lexsort((acc, max_prob))
+    max_prob, acc = max_prob[order], acc[order]
+
+    # number of correct predictions among those with at least the i-th max prob
+    count = np.cumsum(acc[::-1])[::-1]
+    nobs = np.arange(len(acc), 0, -1)
+    # calculate the agresti_coull interval for the accuracy
+    ci_low, ci_upper = proportion_confint(count, nobs, 1 - confidence, 'agresti_coull')
+
     dtype = [('max_prob', float), ('acc', float), ('ci', float)]
-    data = np.array(data, dtype=dtype)
-    data = np.sort(data, order='max_prob')
-    total = data[-1][1]
-    
-    for i in range(1, data.size):
-        total += data[data.size - 1 - i][1]
-        data[data.size - 1 - i][1] = total
-        
-    for i in range(data.size):
-        if use_fraction_rejected:
-            data[i][0] = (i + 1)/data.size
-        count = data[i][1]
-        nobs = data.size - i
-        # calculate the agresti_coull interval for the accuracy
-        ci_low, ci_upper = proportion_confint(count, nobs, 1 - confidence, 'agresti_coull')
-        data[i][1] = count/nobs
-        data[i][2] = (ci_upper - ci_low)/2
-        
+    data = np.empty(len(acc), dtype=dtype)
+    data['max_prob'] = np.arange(1, len(acc) + 1) / len(acc) if use_fraction_rejected else max_prob
+    data['acc'] = count / nobs
+    data['ci'] = (ci_upper - ci_low) / 2
     return data
 
 def generate_conf_mat(pred: List[int], y_true: List[int], 
@@ -303,7 +466,8 @@ def calibration_evaluation(class_probs: List[List[int]],
                            temp_scaled: Optional[bool] = False,
                            use_ci: Optional[bool] = False,
                            confidence: Optional[float] = 0.95,
-                           bootstrap_size: Optional[int] = 1000):
+                           bootstrap_size: Optional[int] = 1000,
+                           bootstrap_workers: Optional[int] = None):
     log = {}
     ece, est_acc, conf, density = kernel_ece(class_probs, class_labels, classes, give_kde_points=True)
     
@@ -313,8 +477,10 @@ def calibration_evaluation(class_probs: List[List[int]],
     
     if use_ci:
         ece, ece_lower, ece_upper = kernel_ece_conf_interval(class_probs, class_labels, classes, 
-                                                     confidence=confidence, size=bootstrap_size)
-        brier, brier_lower, brier_upper = brier_conf_interval(class_probs, class_labels, len(classes), confidence, bootstrap_size)
+                                                     confidence=confidence, size=bootstrap_size,
+                                                     num_workers=bootstrap_workers)
+        brier, brier_lower, brier_upper = brier_conf_interval(class_probs, class_labels, len(classes), confidence, bootstrap_size,
+                                                              num_workers=bootstrap_workers)
         ece_lbound_title = f'KDE Expected Calibration Error Lower Bound {add_on}({dataset_type}, Confidence = {confidence})'
         ece_upbound_title = f'KDE Expected Calibration Error Upper Bound {add_on}({dataset_type}, Confidence = {confidence})'
         brier_lbound_title =  f'Brier Score Lower Bound {add_on}({dataset_type}, Confidence = {confidence})'
@@ -340,9 +506,14 @@ def calibration_evaluation(class_probs: List[List[int]],
 
     return log, est_acc, conf, density
 
-def temp_scale_probs(logits: torch.Tensor, temperature: int):
-    scaled_logits = logits / temperature
-    return F.softmax(scaled_logits, dim=1).tolist() 
+# Calibrated probabilities of the logits, as a tensor.
+# temperature may be a number or a tensor of temperatures,
+# which are picked for each sample by groups if given.
+def temp_scale_probs(logits: torch.Tensor, temperature, groups: Optional[torch.Tensor] = None):
+    temperature = torch.as_tensor(temperature, dtype=logits.dtype, device=logits.device)
+    if groups is not None:
+        temperature = temperature[groups, None]
+    return F.softmax(logits / temperature, dim=1)
 
 def rejection_curve(probs: List[List[int]], labels: List[int], classes: List[int],
                      log_path: str, dataset_type: str, temp_scaled: Optional[bool]=False, 